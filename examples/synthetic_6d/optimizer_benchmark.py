@@ -0,0 +1,89 @@
+# time-to-loss of Adam, full-batch L-BFGS and the Adam -> L-BFGS hybrid on
+# the synthetic ground truth beams (see generate_beam_distributions.ipynb)
+
+import json
+import os
+
+import torch
+from bmadx.bmad_torch.track_torch import Beam
+from bmadx.constants import PI
+
+from phase_space_reconstruction.diagnostics import ImageDiagnostic
+from phase_space_reconstruction.telemetry import TrainingTelemetry, time_to_loss
+from phase_space_reconstruction.train import train_3d_scan
+from phase_space_reconstruction.virtual.beamlines import quadlet_tdc_bend
+from phase_space_reconstruction.virtual.scans import run_awa_3d_scan
+
+BEAMS = ["gaussian_beam", "gaussian_beam_w_E_corr", "nonlinear_beam", "eex_beam"]
+RUNS = {
+    "adam": dict(method="adam", n_epochs=400, lr=0.01),
+    "lbfgs": dict(method="lbfgs", n_epochs=30),
+    "hybrid": dict(method="hybrid", n_epochs=215, warmup_epochs=200, lr=0.01),
+}
+N_PARTICLES = 2_000  # reconstruction
+N_GT_PARTICLES = 20_000  # ground truth scan
+N_BINS = 100
+LOG_DIR = os.path.join("data", "optimizer_benchmark")
+
+p0c = 43.36e6  # reference momentum in eV/c
+
+# diagnostic beamline, as in the reconstruction notebooks
+lattice = quadlet_tdc_bend(p0c=p0c, dipole_on=False)
+lattice.elements[0].K1.data = torch.tensor(-24.868402)
+lattice.elements[2].K1.data = torch.tensor(26.179029)
+lattice.elements[4].K1.data = torch.tensor(-26.782126)
+
+scan_ids = [6, 8, 10]
+ks = torch.linspace(-3, 3, 5)  # quad ks
+vs = torch.tensor([0, 3e6])  # TDC off/on
+gs = torch.tensor([-2.22e-16, -20.0 * PI / 180.0 / 0.365])  # dipole off/on
+
+bins = torch.linspace(-5, 5, N_BINS) * 1e-3
+bandwidth = (bins[1] - bins[0]) / 2
+screen = ImageDiagnostic(bins, bins, bandwidth)
+
+os.makedirs(LOG_DIR, exist_ok=True)
+
+for name in BEAMS:
+    fname = os.path.join("data", f"{name}.pt")
+    if not os.path.exists(fname):
+        print(f"{fname} not found, run generate_beam_distributions.ipynb")
+        continue
+
+    gt_beam = torch.load(fname, weights_only=False)
+    gt_beam = Beam(gt_beam.data[:N_GT_PARTICLES], gt_beam.p0c, gt_beam.s, gt_beam.mc2)
+    dset = run_awa_3d_scan(gt_beam, lattice, screen, ks, vs, gs, ids=scan_ids)
+
+    final_losses = {}
+    for run, kwargs in RUNS.items():
+        log_file = os.path.join(LOG_DIR, f"{name}_{run}.jsonl")
+        if os.path.exists(log_file):
+            os.remove(log_file)
+
+        torch.manual_seed(0)
+        _, model = train_3d_scan(
+            dset,
+            lattice,
+            p0c,
+            screen,
+            scan_ids,
+            n_particles=N_PARTICLES,
+            telemetry=TrainingTelemetry(log_file, print_frequency=0),
+            eval_loss=True,
+            **kwargs,
+        )
+        with open(log_file) as f:
+            records = [json.loads(line) for line in f]
+        final_losses[run] = min(r["eval_loss"] for r in records if "eval_loss" in r)
+
+    # time until the full-batch loss of each method is within 10% of the best
+    # loss of all methods
+    target = 1.1 * min(final_losses.values())
+    for run in RUNS:
+        log_file = os.path.join(LOG_DIR, f"{name}_{run}.jsonl")
+        elapsed = time_to_loss(log_file, target, key="eval_loss")
+        elapsed = "not reached" if elapsed is None else f"{elapsed:.1f} s"
+        print(
+            f"{name} {run}: best loss {final_losses[run]:.4e}, "
+            f"time to {target:.4e}: {elapsed}"
+        )
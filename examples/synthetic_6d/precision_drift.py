@@ -0,0 +1,69 @@
+# numerical drift of the bf16 mixed precision training mode against float32
+# for the synthetic ground truth beams (see generate_beam_distributions.ipynb)
+
+import os
+
+import torch
+from bmadx.bmad_torch.track_torch import Beam
+from bmadx.constants import PI
+
+from phase_space_reconstruction.diagnostics import ImageDiagnostic
+from phase_space_reconstruction.modeling import (
+    InitialBeam,
+    NNTransform,
+    PhaseSpaceReconstructionModel3D,
+)
+from phase_space_reconstruction.precision import precision_drift, print_precision_drift
+from phase_space_reconstruction.virtual.beamlines import quadlet_tdc_bend
+from phase_space_reconstruction.virtual.scans import run_awa_3d_scan
+
+BEAMS = ["gaussian_beam", "gaussian_beam_w_E_corr", "nonlinear_beam", "eex_beam"]
+N_PARTICLES = 10_000  # as in training
+
+p0c = 43.36e6  # reference momentum in eV/c
+
+# diagnostic beamline, as in the reconstruction notebooks
+lattice = quadlet_tdc_bend(p0c=p0c, dipole_on=False)
+lattice.elements[0].K1.data = torch.tensor(-24.868402)
+lattice.elements[2].K1.data = torch.tensor(26.179029)
+lattice.elements[4].K1.data = torch.tensor(-26.782126)
+
+scan_ids = [6, 8, 10]
+ks = torch.linspace(-3, 3, 5)  # quad ks
+vs = torch.tensor([0, 3e6])  # TDC off/on
+gs = torch.tensor([-2.22e-16, -20.0 * PI / 180.0 / 0.365])  # dipole off/on
+
+bins = torch.linspace(-5, 5, 200) * 1e-3
+bandwidth = (bins[1] - bins[0]) / 2
+screen = ImageDiagnostic(bins, bins, bandwidth)
+
+base_dist = torch.distributions.MultivariateNormal(torch.zeros(6), torch.eye(6))
+
+for name in BEAMS:
+    fname = os.path.join("data", f"{name}.pt")
+    if not os.path.exists(fname):
+        print(f"{fname} not found, run generate_beam_distributions.ipynb")
+        continue
+
+    gt_beam = torch.load(fname, weights_only=False)
+    gt_beam = Beam(gt_beam.data[:N_PARTICLES], gt_beam.p0c, gt_beam.s, gt_beam.mc2)
+    dset = run_awa_3d_scan(gt_beam, lattice, screen, ks, vs, gs, ids=scan_ids)
+
+    # screen kernels only: the ground truth beam through an identity transform
+    gt_model_beam = InitialBeam(torch.nn.Identity(), base_dist, 1, p0c=gt_beam.p0c)
+    gt_model_beam.base_beam = gt_beam
+    gt_model = PhaseSpaceReconstructionModel3D(lattice.copy(), screen, gt_model_beam)
+    report = precision_drift(gt_model, dset.params, scan_ids, dset.images)
+    print_precision_drift(report, f"{name} (ground truth)")
+
+    # NN transform and screen kernels, against the measured images
+    torch.manual_seed(0)
+    nn_beam = InitialBeam(
+        NNTransform(2, 20, output_scale=1e-3),
+        base_dist,
+        N_PARTICLES,
+        p0c=gt_beam.p0c,
+    )
+    nn_model = PhaseSpaceReconstructionModel3D(lattice.copy(), screen, nn_beam)
+    report = precision_drift(nn_model, dset.params, scan_ids, dset.images)
+    print_precision_drift(report, f"{name} (NN beam)")
@@ -0,0 +1,379 @@
+import copy
+
+import torch
+from bmadx.bmad_torch.track_torch import Beam
+from torch import nn
+
+from phase_space_reconstruction.losses import MAELoss, normalize_images
+from phase_space_reconstruction.modeling import (
+    ConditionalNNTransform,
+    InitialBeam,
+    PhaseSpaceNormalization,
+    PhaseSpaceReconstructionModel3D,
+)
+from phase_space_reconstruction.telemetry import TrainingTelemetry
+from phase_space_reconstruction.virtual.scans import run_awa_3d_scan
+
+N_TRIL = 21  # entries of a 6x6 lower triangular matrix
+
+
+class ScanEncoder(nn.Module):
+    def __init__(self, n_latent=8, width=64, n_channels=16):
+        """
+        Permutation invariant encoder of a full 3D scan: every image is
+        embedded by a small CNN together with its scan parameters, the
+        embeddings are averaged over configurations and mapped to a beam
+        centroid, Cholesky factor and latent code, all relative to a
+        reference normalization.
+
+        Parameters
+        ----------
+        n_latent: int
+            size of the latent code of the correction network
+
+        width: int
+            width of the hidden layers
+
+        n_channels: int
+            channels of the convolutional layers
+        """
+        super(ScanEncoder, self).__init__()
+        self.n_latent = n_latent
+
+        self.conv = nn.Sequential(
+            nn.Conv2d(1, n_channels, 5, stride=2, padding=2),
+            nn.Tanh(),
+            nn.Conv2d(n_channels, n_channels, 5, stride=2, padding=2),
+            nn.Tanh(),
+            nn.Conv2d(n_channels, n_channels, 3, stride=2, padding=1),
+            nn.Tanh(),
+            nn.AdaptiveAvgPool2d(4),
+            nn.Flatten(),
+        )
+        self.config_net = nn.Sequential(
+            nn.Linear(16 * n_channels + 3, width),
+            nn.Tanh(),
+            nn.Linear(width, width),
+            nn.Tanh(),
+        )
+        self.head = nn.Sequential(
+            nn.Linear(width, width),
+            nn.Tanh(),
+            nn.Linear(width, 6 + N_TRIL + n_latent),
+        )
+        # start at the reference beam
+        nn.init.zeros_(self.head[-1].weight)
+        nn.init.zeros_(self.head[-1].bias)
+
+        self.register_buffer("params_mean", torch.zeros(3))
+        self.register_buffer("params_scale", torch.ones(3))
+        self.register_buffer("tril_indices", torch.tril_indices(6, 6))
+
+    def set_params_normalization(self, params):
+        """Standardizes scan parameters to the range of `params`, [..., 3, 1]."""
+        params = params.reshape(-1, 3)
+        self.params_mean = params.mean(dim=0)
+        scale = params.std(dim=0)
+        self.params_scale = torch.where(scale > 0, scale, 1.0)
+
+    def forward(self, params, images):
+        """
+        Parameters
+        ----------
+        params: Tensor
+            scan parameters, shape [..., n_configs, 3, 1]
+
+        images: Tensor
+            scan images, shape [..., n_configs, 1, H, W]
+
+        Returns
+        -------
+        mean: Tensor
+            normalized centroid, shape [..., 6]
+
+        scale_tril: Tensor
+            normalized Cholesky factor, shape [..., 6, 6]
+
+        code: Tensor
+            latent code, shape [..., n_latent]
+        """
+        batch_shape = images.shape[:-3]
+        pixels = images.shape[-2] * images.shape[-1]
+        images = normalize_images(images) * pixels
+
+        features = self.conv(images.reshape(-1, *images.shape[-3:]))
+        features = features.reshape(*batch_shape, -1)
+        params = (params.squeeze(-1) - self.params_mean) / self.params_scale
+
+        embedding = self.config_net(torch.cat((features, params), dim=-1))
+        output = self.head(embedding.mean(dim=-2))
+
+        mean = output[..., :6]
+        tril = output[..., 6 : 6 + N_TRIL]
+        code = output[..., 6 + N_TRIL :]
+
+        scale_tril = torch.zeros(*tril.shape[:-1], 6, 6).to(tril)
+        scale_tril[..., self.tril_indices[0], self.tril_indices[1]] = tril
+        diagonal = torch.diagonal(scale_tril, dim1=-2, dim2=-1)
+        scale_tril = scale_tril - torch.diag_embed(diagonal) + torch.diag_embed(
+            diagonal.exp()
+        )
+
+        return mean, scale_tril, code
+
+
+class LatentCodeTransform(nn.Module):
+    def __init__(self, correction, code):
+        """
+        Residual transformation X + correction(X, code) with a learnable
+        latent code, the refinable form of an encoded beam.
+        """
+        super(LatentCodeTransform, self).__init__()
+        self.correction = correction
+        self.code = nn.Parameter(code)
+
+    def forward(self, X):
+        return X + self.correction(X, self.code)
+
+
+class AmortizedBeam(nn.Module):
+    def __init__(self, encoder, reference, n_particles, p0c, correction=None):
+        """
+        Beam predicted from a scan by a `ScanEncoder`:
+
+            x = mean + L (z + correction(z, code)),
+
+        with z drawn from a standard normal base beam and (mean, L) the
+        encoded centroid and Cholesky factor mapped through the `reference`
+        normalization.
+
+        Parameters
+        ----------
+        encoder: ScanEncoder
+            scan encoder
+
+        reference: PhaseSpaceNormalization
+            normalization of a typical beam of the training family
+
+        n_particles: int
+            number of base beam particles
+
+        p0c: float
+            beam momentum
+
+        correction: ConditionalNNTransform or None
+            correction network taking the latent code as settings. Default:
+            2 hidden layers of width 50, output scale 0.1
+        """
+        super(AmortizedBeam, self).__init__()
+        self.encoder = encoder
+        self.reference = reference
+        self.correction = correction or ConditionalNNTransform(
+            2, 50, encoder.n_latent, output_scale=0.1
+        )
+        self.base_dist = torch.distributions.MultivariateNormal(
+            torch.zeros(6), torch.eye(6)
+        )
+        self.base_beam = None
+        self.set_base_beam(n_particles, p0c=torch.tensor(p0c))
+
+    def set_base_beam(self, n_particles, **kwargs):
+        self.base_beam = Beam(self.base_dist.sample([n_particles]), **kwargs)
+
+    def encode(self, params, images):
+        """Centroid and Cholesky factor in physical units, and latent code."""
+        mean, scale_tril, code = self.encoder(params, images)
+        mean = self.reference.to_physical(mean)
+        scale_tril = self.reference.scale_tril @ scale_tril
+        return mean, scale_tril, code
+
+    def forward(self, params, images):
+        mean, scale_tril, code = self.encode(params, images)
+        z = self.base_beam.data
+        u = z + self.correction(z, code)
+        return Beam(
+            mean + u @ scale_tril.T,
+            self.base_beam.p0c,
+            self.base_beam.s,
+            self.base_beam.mc2,
+        )
+
+    def reconstruct(self, dset, lattice, screen, n_particles=None):
+        """
+        Quick-look reconstruction of a scan as a `PhaseSpaceReconstructionModel3D`,
+        which can be refined by `train.train_3d_scan(..., warm_start=model)`.
+        """
+        with torch.no_grad():
+            mean, scale_tril, code = self.encode(dset.params, dset.images)
+
+        n_particles = n_particles or len(self.base_beam.data)
+        beam = InitialBeam(
+            LatentCodeTransform(copy.deepcopy(self.correction), code),
+            self.base_dist,
+            n_particles,
+            normalization=PhaseSpaceNormalization(mean, scale_tril),
+            p0c=self.base_beam.p0c,
+        )
+        return PhaseSpaceReconstructionModel3D(lattice.copy(), screen, beam)
+
+
+def random_beam(reference, n_particles, p0c, nonlinearity=0.1, generator=None):
+    """
+    Random non-gaussian beam around a reference normalization: a standard
+    normal beam with random linear correlations, scalings and quadratic
+    couplings, mapped to physical coordinates.
+    """
+    z = torch.randn(n_particles, 6, generator=generator)
+    scaling = torch.diag(torch.exp(0.3 * torch.randn(6, generator=generator)))
+    coupling = torch.tril(0.3 * torch.randn(6, 6, generator=generator), -1)
+    u = z @ (scaling + coupling).T
+
+    quadratic = nonlinearity * torch.randn(6, 6, 6, generator=generator) / 6
+    u = u + torch.einsum("ijk,nj,nk->ni", quadratic, u, u)
+    u = u - u.mean(dim=0)
+
+    return Beam(reference.to_physical(u), p0c=torch.tensor(p0c))
+
+
+def generate_virtual_scans(
+    n_scans,
+    reference,
+    lattice,
+    screen,
+    ks,
+    vs,
+    gs,
+    ids,
+    p0c,
+    n_particles=100_000,
+    nonlinearity=0.1,
+    seed=0,
+):
+    """
+    Synthetic 3D scans of random beams, see `random_beam` and
+    `virtual.scans.run_awa_3d_scan`.
+
+    Returns
+    -------
+    dsets: list of ImageDataset3D
+        scans
+
+    moments: list of (mean, cov)
+        ground truth centroid and covariance of each beam, normalized by
+        `reference`
+    """
+    generator = torch.Generator().manual_seed(seed)
+    dsets, moments = [], []
+    for _ in range(n_scans):
+        beam = random_beam(reference, n_particles, p0c, nonlinearity, generator)
+        with torch.no_grad():
+            dsets.append(run_awa_3d_scan(beam, lattice, screen, ks, vs, gs, ids=ids))
+        u = reference.to_normalized(beam.data)
+        moments.append((u.mean(dim=0), torch.cov(u.T)))
+
+    return dsets, moments
+
+
+def train_scan_encoder(
+    model,
+    dsets,
+    lattice,
+    screen,
+    ids,
+    moments=None,
+    n_epochs=100,
+    lr=1e-3,
+    moment_weight=1.0,
+    device="cpu",
+    telemetry=None,
+):
+    """
+    Trains an `AmortizedBeam` offline on synthetic scans. The loss is the
+    image loss of the predicted beam tracked through each scan, plus the
+    squared error of the normalized centroid and covariance when the ground
+    truth `moments` are given.
+
+    Parameters
+    ----------
+    model: AmortizedBeam
+        model to train
+
+    dsets: list of ImageDataset3D
+        training scans, see `generate_virtual_scans`
+
+    lattice: bmadx TorchLattice
+        6D diagnostics lattice with quadrupole, TDC and dipole
+
+    screen: ImageDiagnostic
+        screen diagnostics
+
+    ids: list of ints
+        Indices of the elements to be scanned: [quad_id, tdc_id, dipole_id]
+
+    moments: list of (mean, cov) or None
+        normalized ground truth moments of the scans
+
+    n_epochs: int
+        number of epochs, each visits all scans once
+
+    device: 'cpu' or 'cuda:0'
+        device to train the model on
+
+    telemetry: TrainingTelemetry or None
+        step timing and logging of the loss averaged over the scans of an
+        epoch. Default: print the loss every 100 epochs
+
+    Returns
+    -------
+    model: AmortizedBeam
+        trained model
+    """
+    # Device selection:
+    DEVICE = torch.device(device)
+    print(f"Using device: {DEVICE}")
+
+    model.encoder.set_params_normalization(torch.cat([d.params for d in dsets]))
+    model = model.to(DEVICE)
+    scans = [(d.params.to(DEVICE), d.images.to(DEVICE)) for d in dsets]
+    if moments is not None:
+        moments = [(mean.to(DEVICE), cov.to(DEVICE)) for mean, cov in moments]
+
+    scan_model = PhaseSpaceReconstructionModel3D(lattice.copy(), screen, None)
+    # the model itself as the beam, for the telemetry sampling hooks
+    scan_model.beam = model
+    scan_model = scan_model.to(DEVICE)
+    telemetry = (telemetry or TrainingTelemetry()).attach(scan_model)
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    loss_fn = MAELoss()
+
+    for i in range(n_epochs + 1):
+        telemetry.start_epoch(i)
+        losses = []
+        for j in torch.randperm(len(scans)).tolist():
+            params, images = scans[j]
+            telemetry.start_step()
+            optimizer.zero_grad()
+            beam = model(params, images)
+            observations, _ = scan_model.track_and_observe_beam(beam, params, ids)
+            telemetry.mark("forward")
+            loss = loss_fn((observations,), images)
+
+            if moments is not None:
+                mean, cov = moments[j]
+                u = model.reference.to_normalized(beam.data)
+                loss = loss + moment_weight * (
+                    (u.mean(dim=0) - mean).pow(2).mean()
+                    + (torch.cov(u.T) - cov).pow(2).mean()
+                )
+            telemetry.mark("loss")
+
+            loss.backward()
+            telemetry.mark("backward")
+            optimizer.step()
+            telemetry.end_step(len(params))
+            losses.append(loss.detach())
+
+        telemetry.end_epoch(i, torch.stack(losses).mean(), optimizer)
+
+    telemetry.detach()
+    return model.to("cpu")
@@ -1,6 +1,10 @@
 import torch
+from bmadx.bmad_torch.track_torch import Beam
 from torch import nn
 
+from phase_space_reconstruction.modeling import PhaseSpaceNormalization
+from phase_space_reconstruction.moments import COORDINATES
+
 
 class NNBeam(nn.Module):
     def __init__(
@@ -29,3 +33,99 @@ class NNBeam(nn.Module):
 
     def forward(self, X):
         return self.stack(X) * self.output_scale
+
+
+class GaussianMixtureBeam(nn.Module):
+    def __init__(self, n_components, mean, cov, p0c, spread=0.5):
+        """
+        Beam modeled as a mixture of `n_components` 6D gaussians. Component
+        centroids and Cholesky factors are parameterized in coordinates
+        normalized by a reference centroid `mean` and covariance `cov`, e.g.
+        from `moments.fit_gaussian_moments`.
+
+        Through a linear transfer map every component stays gaussian, so
+        screen images are rendered analytically by `images`, at a cost of
+        O(n_components x pixels) per scan configuration without particles.
+
+        Parameters
+        ----------
+        n_components: int
+            number of mixture components
+
+        mean: Tensor
+            reference centroid, shape [6]
+
+        cov: Tensor
+            reference covariance, shape [6, 6]
+
+        p0c: float
+            beam momentum of sampled beams
+
+        spread: float
+            initial rms spread of the component centroids in normalized
+            coordinates, the component sizes are chosen such that the
+            mixture covariance matches `cov`. Default: 0.5
+        """
+        super(GaussianMixtureBeam, self).__init__()
+        self.normalization = PhaseSpaceNormalization.from_covariance(cov, mean)
+        self.p0c = p0c
+
+        self.logits = nn.Parameter(torch.zeros(n_components))
+        self.means = nn.Parameter(spread * torch.randn(n_components, 6))
+        self.log_diagonal = nn.Parameter(
+            0.5 * torch.log(torch.tensor(1 - spread**2)) * torch.ones(n_components, 6)
+        )
+        self.off_diagonal = nn.Parameter(torch.zeros(n_components, 15))
+        self.register_buffer("tril_indices", torch.tril_indices(6, 6, -1))
+
+    def mixture(self):
+        """Component weights [K], centroids [K, 6] and Cholesky factors [K, 6, 6]."""
+        weights = torch.softmax(self.logits, dim=0)
+        scale_tril = torch.diag_embed(self.log_diagonal.exp())
+        scale_tril[:, self.tril_indices[0], self.tril_indices[1]] = self.off_diagonal
+
+        means = self.normalization.to_physical(self.means)
+        scale_tril = self.normalization.scale_tril @ scale_tril
+        return weights, means, scale_tril
+
+    def forward(self, n_particles):
+        """Beam of `n_particles` sampled from the mixture."""
+        weights, means, scale_tril = self.mixture()
+        components = torch.multinomial(weights.detach(), n_particles, True)
+        z = torch.randn(n_particles, 6, 1).to(means)
+        coords = means[components] + (scale_tril[components] @ z).squeeze(-1)
+        return Beam(coords, p0c=torch.tensor(self.p0c))
+
+    def images(self, R, offset, screen):
+        """
+        Screen images of the mixture after the linear transfer maps `R`,
+        shape [n_configs, 6, 6], with reference orbit `offset`, shape
+        [n_configs, 6], see `moments.transfer_matrices`. The gaussian KDE
+        kernel of `screen` is included. Returns images with shape
+        [n_configs, 1, H, W], like an `ImageDiagnostic` of the sampled beam.
+        """
+        rows = [COORDINATES.index(screen.x), COORDINATES.index(screen.y)]
+        R, offset = R[:, rows], offset[:, rows]
+
+        weights, means, scale_tril = self.mixture()
+        cov = scale_tril @ scale_tril.transpose(-2, -1)
+
+        # projected moments, shapes [n_configs, K, 2] and [n_configs, K, 2, 2]
+        centroid = offset.unsqueeze(1) + torch.einsum("nai,ki->nka", R, means)
+        cov = torch.einsum("nai,kij,nbj->nkab", R, cov, R)
+        cov = cov + screen.bandwidth**2 * torch.eye(2).to(cov)
+
+        det = cov[..., 0, 0] * cov[..., 1, 1] - cov[..., 0, 1] ** 2
+        dx = screen.bins_x.reshape(1, 1, -1, 1) - centroid[..., 0, None, None]
+        dy = screen.bins_y.reshape(1, 1, 1, -1) - centroid[..., 1, None, None]
+        exponent = (
+            cov[..., 1, 1, None, None] * dx**2
+            - 2 * cov[..., 0, 1, None, None] * dx * dy
+            + cov[..., 0, 0, None, None] * dy**2
+        ) / (-2 * det[..., None, None])
+        density = torch.exp(exponent) / (2 * torch.pi * det.sqrt()[..., None, None])
+
+        images = torch.einsum("k,nkij->nij", weights, density).unsqueeze(1)
+        if screen.normalize:
+            images = images / (images.sum(dim=(-2, -1), keepdim=True) + 1e-10)
+        return images
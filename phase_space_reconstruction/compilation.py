@@ -0,0 +1,166 @@
+import torch
+
+
+def explain_graph_breaks(fn, *example_inputs, verbose=True):
+    """
+    Traces `fn` with torch dynamo and reports where it splits into separate
+    graphs.
+
+    Parameters
+    ----------
+    fn: callable
+        function or module to analyse
+
+    example_inputs:
+        inputs to run `fn` with
+
+    verbose: bool
+        print the summary. Default: True
+
+    Returns
+    -------
+    torch._dynamo ExplainOutput
+    """
+    explanation = torch._dynamo.explain(fn)(*example_inputs)
+    if verbose:
+        print(
+            f"{explanation.graph_count} graphs, "
+            f"{explanation.graph_break_count} graph breaks"
+        )
+        for reason in explanation.break_reasons:
+            print(f"  {reason.reason}")
+            for frame in reason.user_stack[-1:]:
+                print(f"    {frame.filename}:{frame.lineno}")
+
+    return explanation
+
+
+def _outputs_and_grads(fn, parameters, inputs):
+    for param in parameters:
+        param.grad = None
+    output = fn(*inputs)
+    output.sum().backward()
+    grads = [p.grad.clone() for p in parameters if p.grad is not None]
+    for param in parameters:
+        param.grad = None
+
+    return output.detach(), grads
+
+
+def check_against_eager(
+    fn, compiled_fn, parameters, *example_inputs, rtol=1e-3, atol=1e-7
+):
+    """
+    Checks that a compiled loss function and its gradients with respect to
+    `parameters` match eager mode. Losses with one value per configuration
+    are summed for the gradient check.
+
+    Raises
+    ------
+    RuntimeError if the results differ by more than (rtol, atol)
+    """
+    parameters = list(parameters)
+    eager_loss, eager_grads = _outputs_and_grads(fn, parameters, example_inputs)
+    loss, grads = _outputs_and_grads(compiled_fn, parameters, example_inputs)
+
+    if not torch.allclose(loss, eager_loss, rtol=rtol, atol=atol):
+        raise RuntimeError(
+            "compiled loss differs from eager, max abs difference "
+            f"{(loss - eager_loss).abs().max().item()}"
+        )
+    for grad, eager_grad in zip(grads, eager_grads):
+        if not torch.allclose(grad, eager_grad, rtol=rtol, atol=atol):
+            raise RuntimeError(
+                "compiled gradients differ from eager, max abs difference "
+                f"{(grad - eager_grad).abs().max().item()}"
+            )
+
+
+def compile_training_step(
+    model,
+    loss_fn,
+    *example_inputs,
+    check=True,
+    explain=False,
+    mode=None,
+):
+    """
+    Compiles the forward pass of a training step (beam sampling, tracking,
+    diagnostic histograms and loss) into static-shape inductor graphs. The
+    backward pass of the compiled graphs is compiled ahead of time as well.
+    A batch with a different shape (e.g. the last, smaller batch of an epoch)
+    triggers one extra compilation.
+
+    Parameters
+    ----------
+    model: PhaseSpaceReconstructionModel3D
+        model, called as `model(*inputs)`
+
+    loss_fn: Module
+        loss, called as `loss_fn(model(*inputs), target_images)`
+
+    example_inputs:
+        (*model inputs, target_images) of a representative batch
+
+    check: bool
+        compare loss and gradients against eager mode on the example batch.
+        Default: True
+
+    explain: bool
+        print graph-break diagnostics. Default: False
+
+    mode: str or None
+        torch.compile mode, e.g. 'max-autotune'
+
+    Returns
+    -------
+    callable with the signature of `step_loss(*model_inputs, target_images)`
+    """
+
+    def step_loss(*inputs):
+        *model_inputs, target_images = inputs
+        return loss_fn(model(*model_inputs), target_images)
+
+    compiled = torch.compile(step_loss, backend="inductor", dynamic=False, mode=mode)
+
+    if explain:
+        explain_graph_breaks(step_loss, *example_inputs)
+    if check:
+        check_against_eager(step_loss, compiled, model.parameters(), *example_inputs)
+
+    return compiled
+
+
+def compile_prediction(model, *example_inputs, check=True, rtol=1e-3, atol=1e-7):
+    """
+    Compiles the forward-only prediction path of a model, e.g. for
+    predicting the images of a test scan.
+
+    Parameters
+    ----------
+    model: PhaseSpaceReconstructionModel3D
+        trained model, called as `model(*inputs)`
+
+    example_inputs:
+        model inputs of a representative batch
+
+    check: bool
+        compare the predicted images against eager mode. Default: True
+
+    Returns
+    -------
+    compiled model
+    """
+    compiled = torch.compile(model, backend="inductor", dynamic=False)
+
+    if check:
+        with torch.no_grad():
+            eager_images = model(*example_inputs)[0]
+            images = compiled(*example_inputs)[0]
+        if not torch.allclose(images, eager_images, rtol=rtol, atol=atol):
+            raise RuntimeError(
+                "compiled predictions differ from eager, max abs difference "
+                f"{(images - eager_images).abs().max().item()}"
+            )
+
+    return compiled
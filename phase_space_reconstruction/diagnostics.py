@@ -13,6 +13,8 @@ class ImageDiagnostic(Module):
         bandwidth: torch.Tensor,
         x="x",
         y="y",
+        normalize=True,
+        kernel_dtype=None,
     ):
         """
         Parameters
@@ -31,17 +33,41 @@ class ImageDiagnostic(Module):
 
         y : str, optional
             Beam attribute coorsponding to the vertical image axis. Default: `y`
+
+        normalize : bool, optional
+            Normalize images to unit sum. Unnormalized images are additive over
+            particle subsets. Default: True
+
+        kernel_dtype : torch.dtype, optional
+            dtype of the kernel evaluation, e.g. torch.bfloat16. Images are
+            accumulated and returned in the dtype of the beam. Default: None,
+            the autocast dtype inside `torch.autocast`, otherwise the dtype of
+            the beam
         """
 
         super(ImageDiagnostic, self).__init__()
         self.x = x
         self.y = y
+        self.normalize = normalize
+        self.kernel_dtype = kernel_dtype
 
         self.register_buffer("bins_x", bins_x)
         self.register_buffer("bins_y", bins_y)
         self.register_buffer("bandwidth", bandwidth)
 
-    def forward(self, beam: Beam):
+    def forward(self, beam: Beam, offsets=None):
+        """
+        Parameters
+        ----------
+        beam : Beam
+            beam at the screen
+
+        offsets : Tensor, optional
+            screen shifts (x, y) in pixels of shape [..., n_shots, 2], the
+            leading dimensions broadcast against the batch shape of the beam.
+            Returns an image of the shifted particles for every shot, with a
+            shot dimension before the pixel dimensions. Default: None
+        """
         x_vals = getattr(beam, self.x)
         y_vals = getattr(beam, self.y)
         if not x_vals.shape == y_vals.shape:
@@ -50,4 +76,25 @@ class ImageDiagnostic(Module):
         if len(x_vals.shape) == 1:
             raise ValueError("coords must be at least 2D")
 
-        return histogram2d(x_vals, y_vals, self.bins_x, self.bins_y, self.bandwidth)
+        if offsets is not None:
+            x_vals = x_vals.unsqueeze(-2) + offsets[..., 0, None] * (
+                self.bins_x[1] - self.bins_x[0]
+            )
+            y_vals = y_vals.unsqueeze(-2) + offsets[..., 1, None] * (
+                self.bins_y[1] - self.bins_y[0]
+            )
+
+        kernel_dtype = self.kernel_dtype
+        device_type = x_vals.device.type
+        if kernel_dtype is None and torch.is_autocast_enabled(device_type):
+            kernel_dtype = torch.get_autocast_dtype(device_type)
+
+        return histogram2d(
+            x_vals,
+            y_vals,
+            self.bins_x,
+            self.bins_y,
+            self.bandwidth,
+            normalize=self.normalize,
+            kernel_dtype=kernel_dtype,
+        )
@@ -0,0 +1,432 @@
+import copy
+import io
+import os
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from bmadx.bmad_torch.track_torch import Beam
+from torch.optim.lr_scheduler import ExponentialLR
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+
+from phase_space_reconstruction.diagnostics import ImageDiagnostic
+from phase_space_reconstruction.losses import MAELoss
+from phase_space_reconstruction.modeling import (
+    ImageDataset3D,
+    InitialBeam,
+    NNTransform,
+    PhaseSpaceReconstructionModel3D,
+)
+from phase_space_reconstruction.telemetry import TrainingTelemetry
+
+
+def init_process_group(backend="gloo", rank=None, world_size=None):
+    """
+    Joins the default process group. Rank, world size and rendezvous address
+    are read from the environment (RANK, WORLD_SIZE, MASTER_ADDR,
+    MASTER_PORT) unless given, which is what `torchrun` sets up on each
+    node of a multi-node job.
+    """
+    if dist.is_initialized():
+        return
+
+    rank = int(os.environ["RANK"]) if rank is None else rank
+    world_size = int(os.environ["WORLD_SIZE"]) if world_size is None else world_size
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+
+def broadcast_module(module, src=0):
+    """Overwrites parameters and buffers of `module` with those of rank `src`."""
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        dist.broadcast(tensor.data, src)
+
+
+def all_reduce_gradients(module, average=True):
+    """Sums (or averages) the gradients of `module` over all ranks."""
+    world_size = dist.get_world_size()
+    for param in module.parameters():
+        if param.grad is not None:
+            dist.all_reduce(param.grad)
+            if average:
+                param.grad /= world_size
+
+
+class _AllReduceSum(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, tensor):
+        tensor = tensor.clone()
+        dist.all_reduce(tensor)
+        return tensor
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        # every rank evaluates the same loss on the reduced tensor, so the
+        # reduced gradient is already the gradient of each partial sum
+        return grad_output
+
+
+def all_reduce_sum(tensor):
+    """Differentiable sum of `tensor` over all ranks."""
+    return _AllReduceSum.apply(tensor)
+
+
+def train_3d_scan_distributed(
+    train_dset,
+    lattice,
+    p0c,
+    screen,
+    ids,
+    n_epochs=100,
+    n_particles=10_000,
+    save_dir=None,
+    batch_size=10,
+    nn_transform=None,
+    distribution_dump_frequency=1000,
+    distribution_dump_n_particles=100_000,
+    use_decay=False,
+    lr=0.01,
+    seed=0,
+    telemetry=None,
+):
+    """
+    Data parallel version of `train.train_3d_scan` over torch.distributed.
+    Scan configurations are sharded across ranks, every rank tracks its
+    shard with the same base beam and gradients are averaged with an
+    all-reduce before each optimizer step. Works with the gloo backend on
+    CPU-only nodes; the process group must be initialized first (see
+    `init_process_group` and `launch_local`).
+
+    Parameters
+    ----------
+    train_dset: ImageDataset3D
+        training data, identical on every rank
+
+    lattice: bmadx TorchLattice
+        6D diagnostics lattice with quadrupole, TDC and dipole
+
+    p0c: float
+        beam momentum
+
+    screen: ImageDiagnostic
+        screen diagnostics
+
+    ids: list of ints
+        Indices of the elements to be scanned: [quad_id, tdc_id, dipole_id]
+
+    n_epochs: int
+        number of epochs for the optimizer
+
+    n_particles: int
+        number of particles in the reconstructed beam (on every rank)
+
+    save_dir: str or None
+        directory for distribution dumps, written by rank 0 only
+
+    batch_size: int
+        global batch size, split evenly between ranks
+
+    seed: int
+        seed shared by all ranks for the model, base beam and shuffling
+
+    telemetry: TrainingTelemetry or None
+        step timing and loss logging on rank 0, the loss is averaged over
+        ranks. Other ranks log nothing. Default: print the loss every 100
+        epochs
+
+    Returns
+    -------
+    predicted_beam: bmadx Beam
+        reconstructed beam
+
+    model: PhaseSpaceReconstructionModel3D
+        trained model
+    """
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+
+    sampler = DistributedSampler(
+        ImageDataset3D(train_dset.params, train_dset.images),
+        num_replicas=world_size,
+        rank=rank,
+        shuffle=True,
+        seed=seed,
+    )
+    train_dataloader = DataLoader(
+        sampler.dataset,
+        batch_size=max(1, batch_size // world_size),
+        sampler=sampler,
+    )
+
+    # create phase space reconstruction model, identical on all ranks
+    torch.manual_seed(seed)
+    nn_transformer = nn_transform or NNTransform(2, 20, output_scale=1e-3)
+    nn_beam = InitialBeam(
+        nn_transformer,
+        torch.distributions.MultivariateNormal(torch.zeros(6), torch.eye(6)),
+        n_particles,
+        p0c=torch.tensor(p0c),
+    )
+    model = PhaseSpaceReconstructionModel3D(lattice.copy(), screen, nn_beam)
+
+    # the base beam is a buffer, so this also synchronizes it
+    broadcast_module(model)
+
+    # train model
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+
+    if use_decay:
+        gamma = 0.999  # final learning rate will be gamma * lr
+        scheduler = ExponentialLR(optimizer, gamma)
+    loss_fn = MAELoss()
+
+    # progress is logged by rank 0 only
+    if rank != 0:
+        telemetry = TrainingTelemetry(print_frequency=0)
+    telemetry = (telemetry or TrainingTelemetry()).attach(model)
+
+    for i in range(n_epochs + 1):
+        telemetry.start_epoch(i)
+        sampler.set_epoch(i)
+        for elem in train_dataloader:
+            params_i, target_images = elem[0], elem[1]
+            telemetry.start_step()
+            optimizer.zero_grad()
+            output = model(params_i, ids)
+            telemetry.mark("forward")
+            loss = loss_fn(output, target_images)
+            telemetry.mark("loss")
+            loss.backward()
+            telemetry.mark("backward")
+            all_reduce_gradients(model)
+            telemetry.mark("all_reduce")
+            optimizer.step()
+            telemetry.end_step(len(params_i))
+
+        loss = loss.detach().clone()
+        dist.all_reduce(loss)
+        telemetry.end_epoch(i, loss / world_size, optimizer)
+
+        # dump current particle distribution to file
+        if i % distribution_dump_frequency == 0:
+            if save_dir is not None and rank == 0:
+                model_copy = copy.deepcopy(model)
+                model_copy.beam.set_base_beam(
+                    distribution_dump_n_particles, p0c=torch.tensor(p0c)
+                )
+                torch.save(
+                    model_copy.beam.forward().detach_clone(),
+                    os.path.join(save_dir, f"dist_{i}.pt"),
+                )
+        if use_decay:
+            scheduler.step()
+
+    telemetry.detach()
+
+    predicted_beam = model.beam.forward().detach_clone()
+
+    return predicted_beam, copy.deepcopy(model)
+
+
+def train_3d_scan_particle_sharded(
+    train_dset,
+    lattice,
+    p0c,
+    screen,
+    ids,
+    n_epochs=100,
+    n_particles=10_000,
+    save_dir=None,
+    batch_size=10,
+    nn_transform=None,
+    distribution_dump_frequency=1000,
+    distribution_dump_n_particles=100_000,
+    use_decay=False,
+    lr=0.01,
+    seed=0,
+    telemetry=None,
+):
+    """
+    Particle parallel version of `train.train_3d_scan` over torch.distributed.
+    The base beam is split across ranks: every rank tracks its
+    `n_particles / world_size` particles through all configurations of the
+    batch and builds unnormalized screen images, which are summed over ranks
+    before the loss. Histograms are additive, so the total particle count
+    grows with the number of ranks even for small scan grids. The process
+    group must be initialized first (see `init_process_group` and
+    `launch_local`).
+
+    Parameters
+    ----------
+    train_dset: ImageDataset3D
+        training data, identical on every rank
+
+    n_particles: int
+        total number of particles, split evenly between ranks
+
+    seed: int
+        seed for the model and the batch order (shared by all ranks) and the
+        base beam shards (offset by the rank)
+
+    telemetry: TrainingTelemetry or None
+        step timing and loss logging on rank 0. Default: print the loss
+        every 100 epochs
+
+    See `train_3d_scan_distributed` for the other parameters.
+
+    Returns
+    -------
+    predicted_beam: bmadx Beam
+        reconstructed beam, gathered from all ranks
+
+    model: PhaseSpaceReconstructionModel3D
+        trained model holding this rank's shard of the base beam
+    """
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+
+    # identical batches on all ranks
+    train_dataloader = DataLoader(
+        ImageDataset3D(train_dset.params, train_dset.images),
+        batch_size=batch_size,
+        shuffle=True,
+        generator=torch.Generator().manual_seed(seed),
+    )
+
+    # partial images must not be normalized before the reduction
+    partial_screen = ImageDiagnostic(
+        screen.bins_x,
+        screen.bins_y,
+        screen.bandwidth,
+        x=screen.x,
+        y=screen.y,
+        normalize=False,
+    )
+
+    # create phase space reconstruction model, identical on all ranks
+    torch.manual_seed(seed)
+    nn_transformer = nn_transform or NNTransform(2, 20, output_scale=1e-3)
+    nn_beam = InitialBeam(
+        nn_transformer,
+        torch.distributions.MultivariateNormal(torch.zeros(6), torch.eye(6)),
+        n_particles // world_size,
+        p0c=torch.tensor(p0c),
+    )
+    model = PhaseSpaceReconstructionModel3D(lattice.copy(), partial_screen, nn_beam)
+    broadcast_module(model)
+
+    # draw an independent base beam shard on each rank
+    torch.manual_seed(seed + rank + 1)
+    model.beam.set_base_beam(n_particles // world_size, p0c=torch.tensor(p0c))
+
+    # train model
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+
+    if use_decay:
+        gamma = 0.999  # final learning rate will be gamma * lr
+        scheduler = ExponentialLR(optimizer, gamma)
+    loss_fn = MAELoss()
+
+    # progress is logged by rank 0 only
+    if rank != 0:
+        telemetry = TrainingTelemetry(print_frequency=0)
+    telemetry = (telemetry or TrainingTelemetry()).attach(model)
+
+    for i in range(n_epochs + 1):
+        telemetry.start_epoch(i)
+        for elem in train_dataloader:
+            params_i, target_images = elem[0], elem[1]
+            telemetry.start_step()
+            optimizer.zero_grad()
+            output = model(params_i, ids)
+            telemetry.mark("forward")
+            images = all_reduce_sum(output[0])
+            telemetry.mark("all_reduce")
+            loss = loss_fn((images, *output[1:]), target_images)
+            telemetry.mark("loss")
+            loss.backward()
+            telemetry.mark("backward")
+            # each rank holds the gradient of its shard's contribution
+            all_reduce_gradients(model, average=False)
+            telemetry.mark("all_reduce")
+            optimizer.step()
+            telemetry.end_step(len(params_i))
+
+        # the loss of the reduced images is the same on all ranks
+        telemetry.end_epoch(i, loss, optimizer)
+
+        # dump current particle distribution to file
+        if i % distribution_dump_frequency == 0:
+            if save_dir is not None and rank == 0:
+                model_copy = copy.deepcopy(model)
+                model_copy.beam.set_base_beam(
+                    distribution_dump_n_particles, p0c=torch.tensor(p0c)
+                )
+                torch.save(
+                    model_copy.beam.forward().detach_clone(),
+                    os.path.join(save_dir, f"dist_{i}.pt"),
+                )
+        if use_decay:
+            scheduler.step()
+
+    telemetry.detach()
+
+    # gather the beam shards
+    shard = model.beam.forward().detach_clone()
+    shards = [torch.empty_like(shard.data) for _ in range(world_size)]
+    dist.all_gather(shards, shard.data)
+    predicted_beam = Beam(torch.cat(shards), shard.p0c, shard.s, shard.mc2)
+
+    return predicted_beam, copy.deepcopy(model)
+
+
+def _local_worker(rank, world_size, port, threads, results, fn, args, kwargs):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    torch.set_num_threads(threads)
+
+    init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        # serialize by value, shared-memory tensors die with this process
+        buffer = io.BytesIO()
+        torch.save(fn(*args, **kwargs), buffer)
+        results.put((rank, buffer.getvalue()))
+    finally:
+        dist.destroy_process_group()
+
+
+def launch_local(fn, world_size, *args, port=29500, threads_per_rank=1, **kwargs):
+    """
+    Local multi-process harness: runs `fn(*args, **kwargs)` on `world_size`
+    processes of this machine joined in a gloo process group, e.g.
+
+        launch_local(train_3d_scan_distributed, 4, train_dset, lattice, p0c,
+                     screen, ids, n_epochs=10)
+
+    Useful to check distributed trainers without a cluster. For multi-node
+    runs, start the script with `torchrun` and call `init_process_group`
+    instead.
+
+    Returns
+    -------
+    list with the return value of `fn` on each rank, in rank order
+    """
+    ctx = mp.get_context("spawn")
+    results = ctx.SimpleQueue()
+    context = mp.spawn(
+        _local_worker,
+        args=(world_size, port, threads_per_rank, results, fn, args, kwargs),
+        nprocs=world_size,
+        join=False,
+    )
+
+    # drain results while waiting, workers block on large outputs otherwise
+    outputs = {}
+    done = False
+    while not done:
+        done = context.join(timeout=0.1)
+        while not results.empty():
+            rank, output = results.get()
+            outputs[rank] = torch.load(io.BytesIO(output), weights_only=False)
+
+    return [outputs[rank] for rank in range(world_size)]
@@ -0,0 +1,197 @@
+import os
+
+import torch
+import torch.multiprocessing as mp
+
+
+def share_dataset(dset):
+    """
+    Moves the tensors of a scan dataset into shared memory (in place), so
+    that sending the dataset to worker processes does not copy the images.
+
+    Parameters
+    ----------
+    dset: ImageDataset or ImageDataset3D
+        scan dataset
+
+    Returns
+    -------
+    dset: the same dataset object
+    """
+    for value in vars(dset).values():
+        if isinstance(value, torch.Tensor):
+            value.share_memory_()
+
+    return dset
+
+
+def available_cores():
+    """Returns the sorted ids of the CPU cores this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def partition_cores(n_workers, threads_per_worker=None, cores=None):
+    """
+    Splits the CPU cores available to this process into disjoint slices,
+    one per worker.
+
+    Parameters
+    ----------
+    n_workers: int
+        number of worker processes
+
+    threads_per_worker: int or None
+        cores per worker. Default: all available cores divided evenly.
+
+    cores: list of ints or None
+        cores to distribute. Default: affinity of the current process.
+
+    Returns
+    -------
+    list of lists of core ids
+    """
+    if cores is None:
+        cores = available_cores()
+
+    threads_per_worker = threads_per_worker or max(1, len(cores) // n_workers)
+    if threads_per_worker * n_workers > len(cores):
+        raise ValueError(
+            f"cannot give {n_workers} workers {threads_per_worker} cores each, "
+            f"only {len(cores)} available"
+        )
+
+    return [
+        cores[i * threads_per_worker : (i + 1) * threads_per_worker]
+        for i in range(n_workers)
+    ]
+
+
+def _init_worker(core_queue):
+    # pin this worker to its own slice of cores
+    cores = core_queue.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+
+def pinned_pool(n_workers, threads_per_worker=None, start_method="spawn"):
+    """
+    Creates a multiprocessing pool whose workers are each pinned to their own
+    slice of CPU cores (see `partition_cores`) and run torch with that many
+    threads.
+
+    Returns
+    -------
+    multiprocessing.pool.Pool
+    """
+    core_slices = partition_cores(n_workers, threads_per_worker)
+
+    ctx = mp.get_context(start_method)
+    core_queue = ctx.Queue()
+    for cores in core_slices:
+        core_queue.put(cores)
+
+    return ctx.Pool(n_workers, initializer=_init_worker, initargs=(core_queue,))
+
+
+def _run_trial(task):
+    train_fn, i, kwargs, save_dir = task
+    kwargs = dict(kwargs)
+
+    seed = kwargs.pop("seed", None)
+    if seed is not None:
+        torch.manual_seed(seed)
+
+    result = train_fn(**kwargs)
+
+    # trainers return either the beam or (beam, model)
+    predicted_beam = result[0] if isinstance(result, tuple) else result
+
+    fname = os.path.join(save_dir, f"r_{i}.pt")
+    torch.save(predicted_beam, fname)
+
+    return fname
+
+
+def run_reconstructions(
+    train_fn,
+    save_dir,
+    trials=None,
+    seeds=None,
+    n_workers=None,
+    threads_per_worker=None,
+    start_method="spawn",
+    **train_kwargs,
+):
+    """
+    Runs independent reconstructions on a pool of worker processes, each
+    pinned to a fixed slice of CPU cores. Reconstructed beams are saved as
+    `r_1.pt`, ..., `r_n.pt` in `save_dir`, the layout expected by
+    `examples/synthetic_6d/stats.read_all_particles`.
+
+    Datasets passed in `train_kwargs` or `trials` are moved to shared memory
+    once and are not copied when sent to the workers.
+
+    Parameters
+    ----------
+    train_fn: callable
+        trainer, e.g. `train.train_3d_scan`. Must be importable by the workers.
+
+    save_dir: str
+        directory where the `r_{i}.pt` files are written
+
+    trials: list of dicts or None
+        keyword arguments of each reconstruction, merged over `train_kwargs`.
+        A `seed` entry seeds torch before the trainer is called.
+
+    seeds: iterable of ints or None
+        shortcut for `trials=[{"seed": s} for s in seeds]`
+
+    n_workers: int or None
+        number of worker processes. Default: one per trial, limited by the
+        number of available cores.
+
+    threads_per_worker: int or None
+        torch threads (and pinned cores) per worker. Default: available cores
+        divided evenly between workers.
+
+    start_method: str
+        multiprocessing start method. Default: 'spawn'
+
+    train_kwargs:
+        keyword arguments shared by all reconstructions (`train_dset`,
+        `lattice`, `p0c`, `screen`, ...)
+
+    Returns
+    -------
+    list of str
+        paths of the saved beams, in trial order
+    """
+    if trials is None:
+        if seeds is None:
+            raise ValueError("either trials or seeds must be given")
+        trials = [{"seed": seed} for seed in seeds]
+
+    # place every dataset in shared memory once
+    for kwargs in [train_kwargs, *trials]:
+        for value in kwargs.values():
+            if hasattr(value, "images"):
+                share_dataset(value)
+
+    os.makedirs(save_dir, exist_ok=True)
+    tasks = [
+        (train_fn, i + 1, {**train_kwargs, **trial}, save_dir)
+        for i, trial in enumerate(trials)
+    ]
+
+    n_workers = n_workers or min(len(trials), len(available_cores()))
+    with pinned_pool(n_workers, threads_per_worker, start_method) as pool:
+        fnames = pool.map(_run_trial, tasks, chunksize=1)
+
+    return fnames
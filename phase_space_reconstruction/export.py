@@ -0,0 +1,143 @@
+import copy
+import json
+
+import torch
+from torch import nn
+
+
+class BeamSampler(nn.Module):
+    def __init__(self, beam):
+        """
+        Standalone sampler of a trained `InitialBeam`: maps standard normal
+        coordinates z, shape [N, 6], to physical particle coordinates through
+        the base distribution, the transformer and the normalization of the
+        beam. The transformer is copied and set to evaluation mode, so
+        dropout is off.
+
+        Parameters
+        ----------
+        beam: InitialBeam
+            trained beam with a `MultivariateNormal` base distribution and an
+            unconditional transformer, e.g. `NNTransform` or `FlowTransform`
+        """
+        super(BeamSampler, self).__init__()
+        base_dist = beam.base_dist
+        if not isinstance(base_dist, torch.distributions.MultivariateNormal):
+            raise ValueError("the base distribution must be a MultivariateNormal")
+
+        self.transformer = copy.deepcopy(beam.transformer).eval()
+        self.register_buffer("base_mean", base_dist.loc.detach().clone())
+        self.register_buffer("base_scale_tril", base_dist.scale_tril.detach().clone())
+
+        normalization = beam.normalization
+        if normalization is None:
+            self.register_buffer("mean", torch.zeros(6))
+            self.register_buffer("scale_tril", torch.eye(6))
+        else:
+            self.register_buffer("mean", normalization.mean.detach().clone())
+            self.register_buffer(
+                "scale_tril", normalization.scale_tril.detach().clone()
+            )
+
+        self.metadata = {
+            "p0c": float(beam.base_beam.p0c),
+            "mc2": float(beam.base_beam.mc2),
+            "coordinates": ["x", "px", "y", "py", "z", "pz"],
+        }
+
+    def forward(self, z):
+        base_coords = self.base_mean + z @ self.base_scale_tril.T
+        transformed = self.transformer(base_coords).to(z.dtype)
+        return self.mean + transformed @ self.scale_tril.T
+
+
+def export_beam_sampler(beam, fname, quantize=False, onnx=False):
+    """
+    Serializes a trained `InitialBeam` as a traced TorchScript (default) or
+    ONNX sampler, see `BeamSampler`. Beam momentum and rest energy are
+    stored with the sampler: in the TorchScript file, or in `fname`.json
+    next to an ONNX file. Load with `load_beam_sampler`.
+
+    Parameters
+    ----------
+    beam: InitialBeam
+        trained beam
+
+    fname: str
+        output file
+
+    quantize: bool
+        dynamic int8 quantization of the linear layers of the transformer,
+        for fast generation of large beams on CPU. Default: False
+
+    onnx: bool
+        export to ONNX instead of TorchScript, requires the onnx package.
+        Default: False
+    """
+    sampler = BeamSampler(beam).cpu()
+    if quantize:
+        sampler.transformer = torch.ao.quantization.quantize_dynamic(
+            sampler.transformer, {nn.Linear}, dtype=torch.qint8
+        )
+
+    example = torch.randn(16, 6)
+    metadata = json.dumps(sampler.metadata)
+    with torch.no_grad():
+        if onnx:
+            torch.onnx.export(
+                sampler,
+                (example,),
+                fname,
+                input_names=["z"],
+                output_names=["coords"],
+                dynamic_axes={"z": {0: "n_particles"}, "coords": {0: "n_particles"}},
+            )
+            with open(f"{fname}.json", "w") as f:
+                f.write(metadata)
+        else:
+            traced = torch.jit.trace(sampler, example)
+            torch.jit.save(traced, fname, _extra_files={"metadata.json": metadata})
+
+
+class LoadedBeamSampler:
+    def __init__(self, fname):
+        """
+        Sampler exported by `export_beam_sampler`. Needs torch only, or
+        onnxruntime for ONNX files, not the training code.
+        """
+        self.onnx = fname.endswith(".onnx")
+        if self.onnx:
+            import onnxruntime
+
+            self.session = onnxruntime.InferenceSession(fname)
+            with open(f"{fname}.json") as f:
+                self.metadata = json.load(f)
+        else:
+            extra_files = {"metadata.json": ""}
+            self.module = torch.jit.load(fname, _extra_files=extra_files)
+            self.metadata = json.loads(extra_files["metadata.json"])
+
+        self.p0c = self.metadata["p0c"]
+        self.mc2 = self.metadata["mc2"]
+
+    def sample(self, n_particles, seed=None):
+        """
+        Particle coordinates (x, px, y, py, z, pz), shape [n_particles, 6].
+        The same `seed` gives the same particles.
+        """
+        generator = torch.Generator()
+        if seed is None:
+            generator.seed()
+        else:
+            generator.manual_seed(seed)
+        z = torch.randn(n_particles, 6, generator=generator)
+
+        if self.onnx:
+            return torch.from_numpy(self.session.run(None, {"z": z.numpy()})[0])
+        with torch.no_grad():
+            return self.module(z)
+
+
+def load_beam_sampler(fname):
+    """Loads a sampler exported by `export_beam_sampler`."""
+    return LoadedBeamSampler(fname)
@@ -0,0 +1,165 @@
+import copy
+import math
+
+import torch
+
+
+class DivergenceGuard:
+    def __init__(
+        self,
+        spike_factor=10.0,
+        window=20,
+        snapshot_frequency=10,
+        action="lr",
+        lr_factor=0.5,
+        max_rollbacks=10,
+    ):
+        """
+        Detects non-finite losses or gradients and loss spikes during
+        training, rolls the model and optimizer back to the last in-memory
+        snapshot and reduces the learning rate or redraws the base beam
+        before training continues.
+
+        The trainer calls `check_loss` after the forward pass and
+        `check_gradients` after the backward pass; a step is skipped when
+        either returns False. Full-batch L-BFGS steps are checked after
+        the step, with `check_parameters` and the loss at the new
+        parameters. Snapshots are taken with `end_epoch` every
+        `snapshot_frequency` epochs without events.
+
+        Parameters
+        ----------
+        spike_factor: float
+            a loss larger than `spike_factor` times the median of the last
+            `window` good losses counts as a spike. Default: 10
+
+        window: int
+            number of recent good losses kept. Default: 20
+
+        snapshot_frequency: int
+            epochs between snapshots. Default: 10
+
+        action: 'lr', 'reseed' or 'both'
+            after a rollback, multiply the learning rate by `lr_factor`,
+            redraw the base beam of the model, or both. Default: 'lr'
+
+        lr_factor: float
+            learning rate reduction factor. Default: 0.5
+
+        max_rollbacks: int
+            stop training with a RuntimeError after this many rollbacks.
+            Default: 10
+        """
+        if action not in ("lr", "reseed", "both"):
+            raise ValueError(f"unknown action '{action}'")
+
+        self.spike_factor = spike_factor
+        self.window = window
+        self.snapshot_frequency = snapshot_frequency
+        self.action = action
+        self.lr_factor = lr_factor
+        self.max_rollbacks = max_rollbacks
+
+        self.events = []
+        self._losses = []
+        self._snapshot = None
+        self._epoch_ok = True
+        self._reason = None
+
+    def snapshot(self, model, optimizer, epoch):
+        self._snapshot = {
+            "epoch": epoch,
+            "model": copy.deepcopy(model.state_dict()),
+            "optimizer": copy.deepcopy(optimizer.state_dict()),
+        }
+
+    def check_loss(self, loss):
+        """False if the loss is not finite or a spike."""
+        value = loss.detach().mean().item()
+        if not math.isfinite(value):
+            self._reason = "non-finite loss"
+            return False
+
+        if len(self._losses) >= self.window:
+            reference = sorted(self._losses)[len(self._losses) // 2]
+            if value > self.spike_factor * reference:
+                self._reason = (
+                    f"loss spike {value:.3e} > {self.spike_factor} x {reference:.3e}"
+                )
+                return False
+
+        self._losses = (self._losses + [value])[-self.window :]
+        return True
+
+    def check_gradients(self, model):
+        """False if any gradient is not finite."""
+        for param in model.parameters():
+            if param.grad is not None and not torch.isfinite(param.grad).all():
+                self._reason = "non-finite gradients"
+                return False
+        return True
+
+    def check_parameters(self, model):
+        """False if any parameter is not finite."""
+        for param in model.parameters():
+            if not torch.isfinite(param).all():
+                self._reason = "non-finite parameters"
+                return False
+        return True
+
+    def rollback(self, model, optimizer, epoch, telemetry=None):
+        """
+        Restores the last snapshot and applies the recovery action. Returns
+        the logged event.
+        """
+        if len(self.events) >= self.max_rollbacks:
+            raise RuntimeError(
+                f"training diverged {len(self.events)} times, last: {self._reason}"
+            )
+
+        lrs = [group["lr"] for group in optimizer.param_groups]
+        model.load_state_dict(self._snapshot["model"])
+        optimizer.load_state_dict(self._snapshot["optimizer"])
+        optimizer.zero_grad()
+
+        # reductions accumulate over rollbacks to the same snapshot
+        for group, lr in zip(optimizer.param_groups, lrs):
+            group["lr"] = lr
+            if self.action in ("lr", "both"):
+                group["lr"] *= self.lr_factor
+        if self.action in ("reseed", "both"):
+            base_beam = model.beam.base_beam
+            model.beam.set_base_beam(
+                len(base_beam.data),
+                p0c=base_beam.p0c,
+                s=base_beam.s,
+                mc2=base_beam.mc2,
+            )
+            model.beam.base_beam.data = model.beam.base_beam.data.to(base_beam.data)
+
+        event = {
+            "epoch": epoch,
+            "event": "rollback",
+            "reason": self._reason,
+            "restored_epoch": self._snapshot["epoch"],
+            "action": self.action,
+            "lr": [group["lr"] for group in optimizer.param_groups],
+        }
+        self.events.append(event)
+        self._losses = []
+        self._epoch_ok = False
+
+        print(
+            f"epoch {epoch}: {self._reason}, rolled back to epoch "
+            f"{self._snapshot['epoch']} ({self.action})"
+        )
+        if telemetry is not None:
+            telemetry.event(event)
+
+        return event
+
+    def end_epoch(self, model, optimizer, epoch):
+        """Takes a snapshot every `snapshot_frequency` epochs without events."""
+        if self._epoch_ok and epoch % self.snapshot_frequency == 0:
+            self.snapshot(model, optimizer, epoch)
+        self._epoch_ok = True
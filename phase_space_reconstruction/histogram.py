@@ -13,6 +13,7 @@ def marginal_pdf(
     bins: torch.Tensor,
     sigma: torch.Tensor,
     weights: Optional[Union[Tensor, float]] = None,
+    kernel_dtype: Optional[torch.dtype] = None,
 ) -> Tuple[torch.Tensor, torch.Tensor]:
     """Calculate the marginal probability distribution function of the input tensor based on the number of
     histogram bins.
@@ -22,6 +23,8 @@ def marginal_pdf(
         bins: shape [NUM_BINS].
         sigma: shape [1], gaussian smoothing factor.
         epsilon: scalar, for numerical stability.
+        kernel_dtype: dtype of the kernel evaluation, e.g. torch.bfloat16.
+            Residuals are always computed in the dtype of `values`.
 
     Returns:
         Tuple[torch.Tensor, torch.Tensor]:
@@ -54,10 +57,11 @@ def marginal_pdf(
         weights = 1.0
 
     residuals = values - bins.repeat(*values.shape)
+    exponent = -0.5 * (residuals / sigma).pow(2)
+    if kernel_dtype is not None:
+        exponent = exponent.to(kernel_dtype)
     kernel_values = (
-        weights
-        * torch.exp(-0.5 * (residuals / sigma).pow(2))
-        / torch.sqrt(2 * math.pi * sigma**2)
+        weights * torch.exp(exponent) / torch.sqrt(2 * math.pi * sigma**2)
     )
 
     prob_mass = torch.sum(kernel_values, dim=-2)
@@ -65,7 +69,11 @@ def marginal_pdf(
 
 
 def joint_pdf(
-    kernel_values1: torch.Tensor, kernel_values2: torch.Tensor, epsilon: float = 1e-10
+    kernel_values1: torch.Tensor,
+    kernel_values2: torch.Tensor,
+    epsilon: float = 1e-10,
+    normalize: bool = True,
+    dtype: Optional[torch.dtype] = None,
 ) -> torch.Tensor:
     """Calculate the joint probability distribution function of the input tensors based on the number of histogram
     bins.
@@ -74,6 +82,12 @@ def joint_pdf(
         kernel_values1: shape [BxNxNUM_BINS].
         kernel_values2: shape [BxNxNUM_BINS].
         epsilon: scalar, for numerical stability.
+        normalize: if False, return the unnormalized kernel sums, which are
+            additive over particle subsets.
+        dtype: dtype of the bin products, the returned histogram and its
+            normalization. Kernel values of lower precision are upcast and
+            accumulated in this dtype, also inside `torch.autocast`.
+            Default: dtype of the kernel values.
 
     Returns:
         shape [BxNUM_BINSxNUM_BINS].
@@ -89,7 +103,16 @@ def joint_pdf(
             f"Input kernel_values2 type is not a torch.Tensor. Got {type(kernel_values2)}"
         )
 
-    joint_kernel_values = torch.matmul(kernel_values1.transpose(-2, -1), kernel_values2)
+    if dtype is not None:
+        kernel_values1 = kernel_values1.to(dtype)
+        kernel_values2 = kernel_values2.to(dtype)
+    with torch.autocast(kernel_values1.device.type, enabled=dtype is None):
+        joint_kernel_values = torch.matmul(
+            kernel_values1.transpose(-2, -1), kernel_values2
+        )
+    if not normalize:
+        return joint_kernel_values
+
     normalization = (
         torch.sum(joint_kernel_values, dim=(-2, -1)).unsqueeze(-1).unsqueeze(-1)
         + epsilon
@@ -135,6 +158,8 @@ def histogram2d(
     bins2: torch.Tensor,
     bandwidth: torch.Tensor,
     weights=None,
+    normalize: bool = True,
+    kernel_dtype: Optional[torch.dtype] = None,
 ) -> torch.Tensor:
     """Estimate the 2d histogram of the input tensor.
 
@@ -146,6 +171,11 @@ def histogram2d(
         bins: bin coordinates.
         bandwidth: Gaussian smoothing factor with shape shape [1].
         epsilon: A scalar, for numerical stability. Default: 1e-10.
+        normalize: normalize the histogram to unit sum. Default: True.
+        kernel_dtype: dtype of the kernel evaluation, e.g. torch.bfloat16.
+            The kernel values are upcast and the bin products accumulated in
+            the dtype of `x1`, which is also the dtype of the histogram.
+            Default: None (dtype of `x1`).
 
     Returns:
         Computed histogram of shape :math:`(B, N_{bins}), N_{bins})`.
@@ -159,10 +189,14 @@ def histogram2d(
         torch.Size([2, 128, 128])
     """
 
-    _, kernel_values1 = marginal_pdf(x1.unsqueeze(-1), bins1, bandwidth, weights)
-    _, kernel_values2 = marginal_pdf(x2.unsqueeze(-1), bins2, bandwidth, weights)
+    _, kernel_values1 = marginal_pdf(
+        x1.unsqueeze(-1), bins1, bandwidth, weights, kernel_dtype
+    )
+    _, kernel_values2 = marginal_pdf(
+        x2.unsqueeze(-1), bins2, bandwidth, weights, kernel_dtype
+    )
 
-    pdf = joint_pdf(kernel_values1, kernel_values2)
+    pdf = joint_pdf(kernel_values1, kernel_values2, normalize=normalize, dtype=x1.dtype)
 
     return pdf
 
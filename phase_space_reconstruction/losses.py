@@ -43,18 +43,45 @@ def mae_log_loss(target, pred):
     return torch.mean(torch.abs(torch.log(target + 1e-8) - torch.log(pred + 1e-8)))
 
 
+def reduce_loss(loss, reduction="mean"):
+    """
+    Reduces elementwise losses with a leading configuration dimension:
+    'mean' averages everything, 'none' averages all but the first dimension
+    and returns one value per configuration.
+    """
+    if reduction == "mean":
+        return loss.mean()
+    elif reduction == "none":
+        return loss.flatten(start_dim=1).mean(dim=-1)
+    else:
+        raise ValueError(f"unknown reduction '{reduction}'")
+
+
 class MAELoss(Module):
-    def __init__(self):
+    def __init__(self, reduction="mean"):
+        """
+        Mean absolute error between normalized images. The predicted images
+        broadcast against the targets, e.g. a single prediction against the
+        shot dimension of multi-shot targets.
+
+        Parameters
+        ----------
+        reduction: 'mean' or 'none'
+            return the mean loss or one loss per scan configuration (first
+            image dimension). Default: 'mean'
+        """
         super(MAELoss, self).__init__()
         
+        self.reduction = reduction
         self.loss_record = []
         
     def forward(self, outputs, target_image_original):
-        assert outputs[0].shape == target_image_original.shape
+        shape = target_image_original.shape
+        assert torch.broadcast_shapes(outputs[0].shape, shape) == shape
         target_image = normalize_images(target_image_original)
         pred_image = normalize_images(outputs[0])
         
-        image_loss = mae_loss(target_image, pred_image)
+        image_loss = reduce_loss(torch.abs(target_image - pred_image), self.reduction)
         
         return image_loss
 
@@ -68,14 +95,18 @@ class MENTLoss(Module):
         gamma_=torch.tensor(1.0),
         alpha_=torch.tensor(0.0),
         debug=False,
+        reduction="mean",
+        entropy_weight=torch.tensor(0.0),
     ):
         super(MENTLoss, self).__init__()
 
         self.debug = debug
+        self.reduction = reduction
         self.register_parameter("lambda_", Parameter(lambda_))
         self.register_parameter("beta_", Parameter(beta_))
         self.register_parameter("gamma_", Parameter(gamma_))
         self.register_parameter("alpha_", Parameter(alpha_))
+        self.register_parameter("entropy_weight", Parameter(entropy_weight))
 
         self.loss_record = []
 
@@ -97,12 +128,14 @@ class MENTLoss(Module):
         # compare ellipses
         _, pred_covs = calculate_ellipse(pred_image, x, x)
         _, target_covs = calculate_ellipse(target_image, x, x)
-        cov_loss = mae_loss(pred_covs, target_covs)
+        cov_loss = reduce_loss(torch.abs(pred_covs - target_covs), self.reduction)
 
         # image_loss = kl_div(target_image, pred_image).mean()
-        image_loss = mae_loss(target_image, pred_image)
+        # with reduction='none' the image and ellipse terms are per
+        # configuration, entropy and centroid terms are shared
+        image_loss = reduce_loss(torch.abs(target_image - pred_image), self.reduction)
         total_loss = (
-            -0 * entropy
+            -self.entropy_weight * entropy
             + self.lambda_ * image_loss
             + self.beta_ * centroid_loss
             + self.alpha_ * cov_loss
@@ -1,3 +1,4 @@
+import math
 import time
 from copy import deepcopy
 
@@ -5,12 +6,15 @@ import matplotlib.pyplot as plt
 import torch
 from bmadx import Particle
 from bmadx.bmad_torch.track_torch import Beam, TorchDrift, TorchQuadrupole
+from scipy.spatial import cKDTree
 from torch import nn
 from torch.utils.data import Dataset
 from tqdm import trange
 
 
 class PhaseSpaceReconstructionModel(torch.nn.Module):
+    entropy_fn = None
+
     def __init__(self, lattice, diagnostic, beam):
         super(PhaseSpaceReconstructionModel, self).__init__()
 
@@ -32,16 +36,15 @@ class PhaseSpaceReconstructionModel(torch.nn.Module):
         return observations, final_beam
 
     def forward(self, K, scan_quad_id=0):
-        proposal_beam = self.beam()
+        proposal_beam, entropy = sample_beam_and_entropy(
+            self.beam, entropy_fn=self.entropy_fn
+        )
 
         # track beam
         observations, final_beam = self.track_and_observe_beam(
             proposal_beam, K, scan_quad_id
         )
 
-        # get entropy
-        entropy = calculate_beam_entropy(proposal_beam)
-
         # get beam covariance
         cov = calculate_covariance(proposal_beam)
 
@@ -57,6 +60,50 @@ class VariationalPhaseSpaceReconstructionModel(PhaseSpaceReconstructionModel):
 
         return observations
 
+    def predictive(self, K, n_samples, scan_quad_id=0):
+        """
+        Posterior predictive images of `n_samples` MC-dropout beam samples,
+        drawn in one forward pass: the samples are stacked as [n_samples, 1,
+        n_particles] and tracked and histogrammed together. Dropout is active
+        regardless of the training mode.
+
+        Parameters
+        ----------
+        K: Tensor
+            quadrupole strengths, shape [n_k, 1]
+
+        n_samples: int
+            number of beam samples
+
+        Returns
+        -------
+        image_mean: Tensor
+            pixel-wise mean of the sampled images, shape [n_k, H, W]
+
+        image_variance: Tensor
+            pixel-wise variance of the sampled images, shape [n_k, H, W]
+        """
+        dropout = [m for m in self.beam.modules() if isinstance(m, nn.Dropout)]
+        modes = [m.training for m in dropout]
+        for m in dropout:
+            m.train()
+        try:
+            proposal_beam = self.beam(n_samples=n_samples)
+        finally:
+            for m, mode in zip(dropout, modes):
+                m.train(mode)
+
+        # samples broadcast against the quadrupole strengths
+        proposal_beam = Beam(
+            proposal_beam.data.unsqueeze(1),
+            proposal_beam.p0c,
+            proposal_beam.s,
+            proposal_beam.mc2,
+        )
+        observations, _ = self.track_and_observe_beam(proposal_beam, K, scan_quad_id)
+
+        return observations.mean(dim=0), observations.var(dim=0)
+
 
 class NNTransform(torch.nn.Module):
     def __init__(
@@ -67,9 +114,12 @@ class NNTransform(torch.nn.Module):
         activation=torch.nn.Tanh(),
         output_scale=1e-2,
         phase_space_dim=6,
+        residual=False,
     ):
         """
-        Nonparametric transformation - NN
+        Nonparametric transformation - NN. With `residual` the output is
+        X + NN(X), i.e. the transformation starts near the identity, e.g. at
+        the gaussian of a `PhaseSpaceNormalization`.
         """
         super(NNTransform, self).__init__()
 
@@ -84,28 +134,309 @@ class NNTransform(torch.nn.Module):
 
         self.stack = torch.nn.Sequential(*layer_sequence)
         self.register_buffer("output_scale", torch.tensor(output_scale))
+        self.residual = residual
 
     def forward(self, X):
+        # models pickled before the residual option have no attribute
+        if getattr(self, "residual", False):
+            return X + self.stack(X) * self.output_scale
         return self.stack(X) * self.output_scale
 
 
+class ConditionalNNTransform(torch.nn.Module):
+    def __init__(
+        self,
+        n_hidden,
+        width,
+        n_settings,
+        dropout=0.0,
+        activation=torch.nn.Tanh(),
+        output_scale=1e-2,
+        phase_space_dim=6,
+    ):
+        """
+        Nonparametric transformation conditioned on a vector of machine
+        settings (e.g. gun phase, solenoid and triplet strengths) - NN.
+        Settings are standardized with `settings_mean` and `settings_scale`,
+        see `set_settings_normalization`.
+        """
+        super(ConditionalNNTransform, self).__init__()
+
+        layer_sequence = [nn.Linear(phase_space_dim + n_settings, width), activation]
+
+        for i in range(n_hidden):
+            layer_sequence.append(torch.nn.Linear(width, width))
+            layer_sequence.append(torch.nn.Dropout(dropout))
+            layer_sequence.append(activation)
+
+        layer_sequence.append(torch.nn.Linear(width, phase_space_dim))
+
+        self.stack = torch.nn.Sequential(*layer_sequence)
+        self.register_buffer("output_scale", torch.tensor(output_scale))
+        self.register_buffer("settings_mean", torch.zeros(n_settings))
+        self.register_buffer("settings_scale", torch.ones(n_settings))
+
+    def set_settings_normalization(self, settings):
+        """Standardizes inputs to the range of `settings`, shape [n, n_settings]."""
+        self.settings_mean = settings.mean(dim=0).to(self.settings_mean)
+        if len(settings) > 1:
+            scale = settings.std(dim=0)
+            self.settings_scale = torch.where(scale > 0, scale, 1.0).to(
+                self.settings_scale
+            )
+
+    def forward(self, X, settings):
+        settings = (settings - self.settings_mean) / self.settings_scale
+        settings = settings.expand(*X.shape[:-1], -1)
+        return self.stack(torch.cat((X, settings), dim=-1)) * self.output_scale
+
+
+class AffineCoupling(torch.nn.Module):
+    def __init__(self, mask, n_hidden, width, activation=torch.nn.Tanh()):
+        """
+        Affine coupling layer: coordinates outside `mask` are scaled and
+        shifted by functions of the coordinates in `mask`. Starts as the
+        identity.
+        """
+        super(AffineCoupling, self).__init__()
+
+        layer_sequence = [nn.Linear(len(mask), width), activation]
+        for i in range(n_hidden):
+            layer_sequence.append(torch.nn.Linear(width, width))
+            layer_sequence.append(activation)
+        layer_sequence.append(torch.nn.Linear(width, 2 * len(mask)))
+        torch.nn.init.zeros_(layer_sequence[-1].weight)
+        torch.nn.init.zeros_(layer_sequence[-1].bias)
+
+        self.stack = torch.nn.Sequential(*layer_sequence)
+        self.register_buffer("mask", mask)
+
+    def _scale_and_shift(self, X):
+        log_scale, shift = self.stack(X * self.mask).chunk(2, dim=-1)
+        # bounded scales keep the layer well conditioned
+        return torch.tanh(log_scale) * (1 - self.mask), shift * (1 - self.mask)
+
+    def forward(self, X):
+        log_scale, shift = self._scale_and_shift(X)
+        return X * log_scale.exp() + shift, log_scale.sum(dim=-1)
+
+    def inverse(self, Y):
+        log_scale, shift = self._scale_and_shift(Y)
+        return (Y - shift) * (-log_scale).exp(), -log_scale.sum(dim=-1)
+
+
+class FlowTransform(torch.nn.Module):
+    def __init__(
+        self,
+        n_layers=8,
+        width=64,
+        n_hidden=1,
+        activation=torch.nn.Tanh(),
+        output_scale=1.0,
+        phase_space_dim=6,
+    ):
+        """
+        Invertible transformation - normalizing flow of affine coupling
+        layers, alternately conditioned on positions or momenta and on the
+        first or second half of the coordinates. Unlike `NNTransform` it
+        returns the log Jacobian determinant with the particles
+        (`forward_and_log_det`) and maps particles back to the base
+        distribution (`inverse`), so an `InitialBeam` built on it has an
+        exact density. Starts as the identity times `output_scale`, use it
+        with a `PhaseSpaceNormalization` rather than a small output scale.
+        """
+        super(FlowTransform, self).__init__()
+
+        masks = [
+            torch.arange(phase_space_dim) % 2 == 0,
+            torch.arange(phase_space_dim) % 2 == 1,
+            torch.arange(phase_space_dim) < phase_space_dim // 2,
+            torch.arange(phase_space_dim) >= phase_space_dim // 2,
+        ]
+        self.layers = torch.nn.ModuleList(
+            AffineCoupling(masks[i % 4].float(), n_hidden, width, activation)
+            for i in range(n_layers)
+        )
+        self.register_buffer("output_scale", torch.tensor(output_scale))
+
+    def forward_and_log_det(self, X):
+        log_det = torch.zeros(X.shape[:-1]).to(X)
+        for layer in self.layers:
+            X, layer_log_det = layer(X)
+            log_det = log_det + layer_log_det
+
+        log_det = log_det + X.shape[-1] * self.output_scale.log()
+        return X * self.output_scale, log_det
+
+    def forward(self, X):
+        return self.forward_and_log_det(X)[0]
+
+    def inverse(self, Y):
+        """Base coordinates and log Jacobian determinant of the inverse map."""
+        X = Y / self.output_scale
+        log_det = -Y.shape[-1] * self.output_scale.log() * torch.ones(Y.shape[:-1])
+        log_det = log_det.to(Y)
+        for layer in reversed(self.layers):
+            X, layer_log_det = layer.inverse(X)
+            log_det = log_det + layer_log_det
+
+        return X, log_det
+
+
+class PhaseSpaceNormalization(torch.nn.Module):
+    def __init__(self, mean, scale_tril):
+        """
+        Affine map between normalized and physical phase space coordinates,
+        x = mean + L u, where L is the Cholesky factor of a reference
+        covariance. The reference beam has zero mean and unit covariance in
+        normalized coordinates, so models working in them need no ad-hoc
+        scale factors and stay well conditioned in float32 and bfloat16.
+
+        Parameters
+        ----------
+        mean: Tensor
+            reference centroid, shape [6]
+
+        scale_tril: Tensor
+            lower triangular Cholesky factor of the reference covariance,
+            shape [6, 6]
+        """
+        super(PhaseSpaceNormalization, self).__init__()
+        self.register_buffer("mean", mean)
+        self.register_buffer("scale_tril", scale_tril)
+
+    @classmethod
+    def from_covariance(cls, cov, mean=None):
+        # factorize the correlation matrix, the covariance itself spans many
+        # orders of magnitude
+        std = cov.diagonal().sqrt()
+        corr = cov / torch.outer(std, std)
+        scale_tril = std.unsqueeze(-1) * torch.linalg.cholesky(corr)
+        if mean is None:
+            mean = torch.zeros(len(cov), dtype=cov.dtype)
+
+        return cls(mean, scale_tril)
+
+    @classmethod
+    def from_beam(cls, beam):
+        """Normalization to the centroid and covariance of a bmadx Beam."""
+        return cls.from_covariance(calculate_covariance(beam), beam.data.mean(dim=0))
+
+    @classmethod
+    def from_twiss(cls, twiss_x, twiss_y, twiss_z):
+        """
+        Uncoupled normalization from design Twiss parameters.
+
+        Parameters
+        ----------
+        twiss_x, twiss_y, twiss_z: tuples of floats
+            (beta, alpha, geometric emittance) of the (x, px), (y, py) and
+            (z, pz) planes
+        """
+        cov = torch.zeros(6, 6)
+        for i, (beta, alpha, emittance) in enumerate((twiss_x, twiss_y, twiss_z)):
+            gamma = (1 + alpha**2) / beta
+            cov[2 * i : 2 * i + 2, 2 * i : 2 * i + 2] = emittance * torch.tensor(
+                [[beta, -alpha], [-alpha, gamma]]
+            )
+
+        return cls.from_covariance(cov)
+
+    @property
+    def log_det(self):
+        """log of the Jacobian determinant of the map to physical coordinates."""
+        return self.scale_tril.diagonal().log().sum()
+
+    def to_physical(self, u):
+        with torch.autocast(u.device.type, enabled=False):
+            return self.mean + u.to(self.mean.dtype) @ self.scale_tril.T
+
+    def to_normalized(self, x):
+        with torch.autocast(x.device.type, enabled=False):
+            return torch.linalg.solve_triangular(
+                self.scale_tril, (x - self.mean).T, upper=False
+            ).T
+
+
 class InitialBeam(torch.nn.Module):
-    def __init__(self, transformer, base_dist, n_particles, **kwargs):
+    def __init__(
+        self, transformer, base_dist, n_particles, normalization=None, **kwargs
+    ):
+        """
+        Beam of `n_particles` sampled from `base_dist` and mapped by
+        `transformer`. With a `PhaseSpaceNormalization` the transformer
+        output is in normalized coordinates and converted to physical
+        coordinates here. If `n_active` is set, each forward pass uses a
+        random subset of `n_active` base beam particles. Extra forward
+        arguments (e.g. machine settings for a `ConditionalNNTransform`) are
+        passed on to the transformer.
+
+        With an invertible transformer (`FlowTransform`) the beam has an
+        exact density: `forward(log_prob=True)` also returns the log density
+        of each particle and `log_prob` evaluates it at arbitrary points.
+
+        `forward(n_samples=S)` maps S copies of the base particles in one
+        pass, giving a beam of shape [S, n_particles] whose samples differ
+        through a stochastic transformer, e.g. MC-dropout.
+        """
         super(InitialBeam, self).__init__()
         self.transformer = transformer
         self.base_dist = base_dist
+        self.normalization = normalization
         self.base_beam = None
+        self.n_active = None
 
         self.set_base_beam(n_particles, **kwargs)
 
     def set_base_beam(self, n_particles, **kwargs):
         self.base_beam = Beam(self.base_dist.sample([n_particles]), **kwargs)
 
-    def forward(self):
-        transformed_beam = self.transformer(self.base_beam.data)
-        return Beam(
+    @property
+    def has_density(self):
+        return hasattr(self.transformer, "forward_and_log_det")
+
+    def forward(self, *conditions, log_prob=False, n_samples=None):
+        base_coords = self.base_beam.data
+        if self.n_active is not None and self.n_active < len(base_coords):
+            subset = torch.randperm(len(base_coords), device=base_coords.device)
+            base_coords = base_coords[subset[: self.n_active]]
+        if n_samples is not None:
+            base_coords = base_coords.expand(n_samples, *base_coords.shape)
+
+        if log_prob:
+            transformed_beam, log_det = self.transformer.forward_and_log_det(
+                base_coords, *conditions
+            )
+        else:
+            transformed_beam = self.transformer(base_coords, *conditions)
+
+        # back to the base beam dtype when the transformer runs under autocast
+        transformed_beam = transformed_beam.to(base_coords.dtype)
+        if self.normalization is not None:
+            transformed_beam = self.normalization.to_physical(transformed_beam)
+        beam = Beam(
             transformed_beam, self.base_beam.p0c, self.base_beam.s, self.base_beam.mc2
         )
+        if not log_prob:
+            return beam
+
+        log_density = self.base_dist.log_prob(base_coords) - log_det.to(
+            base_coords.dtype
+        )
+        if self.normalization is not None:
+            log_density = log_density - self.normalization.log_det
+        return beam, log_density
+
+    def log_prob(self, coords, *conditions):
+        """Log density of the beam at physical coordinates `coords`, [..., 6]."""
+        if self.normalization is not None:
+            coords = self.normalization.to_normalized(coords)
+        base_coords, log_det = self.transformer.inverse(coords, *conditions)
+
+        log_density = self.base_dist.log_prob(base_coords) + log_det
+        if self.normalization is not None:
+            log_density = log_density - self.normalization.log_det
+        return log_density
 
 
 class OffsetBeam(torch.nn.Module):
@@ -132,20 +463,121 @@ class OffsetBeam(torch.nn.Module):
         )
 
 
+class ShotJitter(torch.nn.Module):
+    def __init__(self, config_shape, n_shots):
+        """
+        Learnable per-shot centroid jitter of multi-shot scans. Through the
+        linear map of a scan configuration a centroid offset of the incoming
+        beam is a shift of the screen image, so the jitter is parameterized
+        directly by the screen shift of every shot, in pixels. The shifts are
+        added to the screen coordinates of the particles tracked once per
+        configuration, before the histogram, see `ImageDiagnostic`. They have
+        zero mean over the shots of every configuration, the mean image
+        position is left to the beam centroid.
+
+        Parameters
+        ----------
+        config_shape: tuple of ints
+            shape of the scan configurations, e.g. (n_quad, n_tdc, n_dipole)
+
+        n_shots: int
+            images per configuration
+        """
+        super(ShotJitter, self).__init__()
+        self.offsets = nn.Parameter(torch.zeros(*config_shape, n_shots, 2))
+
+    def forward(self, indices):
+        """
+        Screen shifts (x, y) in pixels of the configurations `indices` (first
+        configuration dimension), shape [len(indices), ..., n_shots, 2].
+        """
+        offsets = self.offsets[indices]
+        # shot-to-shot jitter only, the beam centroid sets the mean position
+        return offsets - offsets.mean(dim=-2, keepdim=True)
+
+
 def calculate_covariance(beam):
-    # note: multiply and divide by 1e3 to help underflow issues
-    return torch.cov(beam.data.T * 1e3) * 1e-6
+    # note: never under autocast
+    with torch.autocast(beam.data.device.type, enabled=False):
+        return torch.cov(beam.data.T)
 
 
 def calculate_entropy(cov):
-    emit = (torch.det(cov * 1e9)) ** 0.5 * 1e-27
-    return torch.log((2 * 3.14 * 2.71) ** 3 * emit)
+    # entropy of a gaussian with covariance `cov`, the log determinant does
+    # not underflow in float32 like det(cov) ~ 1e-36 does
+    n = cov.shape[-1]
+    return 0.5 * torch.linalg.slogdet(cov)[1] + 0.5 * n * math.log(2 * math.pi * math.e)
 
 
 def calculate_beam_entropy(beam):
     return calculate_entropy(calculate_covariance(beam))
 
 
+def calculate_knn_entropy(beam, k=3, n_samples=2048):
+    """
+    Kozachenko-Leonenko k-nearest neighbor estimate of the differential
+    entropy of the beam particles, differentiable with respect to the
+    particle coordinates. Neighbors are searched with a KD-tree on a random
+    subset of `n_samples` particles, which bounds the cost independently of
+    the beam size; the search itself is not differentiated. Coordinates are
+    whitened by the (fixed) beam covariance first, so that all phase space
+    directions count alike, and its log determinant is added back.
+
+    Parameters
+    ----------
+    beam: bmadx Beam
+        particle beam
+
+    k: int
+        neighbor order. Default: 3
+
+    n_samples: int
+        size of the particle subset. Default: 2048
+    """
+    # note: never under autocast
+    with torch.autocast(beam.data.device.type, enabled=False):
+        coords = beam.data
+        if len(coords) > n_samples:
+            subset = torch.randperm(len(coords), device=coords.device)
+            coords = coords[subset[:n_samples]]
+        n, d = coords.shape
+
+        scale_tril = torch.linalg.cholesky(torch.cov(coords.detach().T))
+        u = torch.linalg.solve_triangular(
+            scale_tril, (coords - coords.detach().mean(dim=0)).T, upper=False
+        ).T
+
+        u_numpy = u.detach().cpu().numpy()
+        _, indices = cKDTree(u_numpy).query(u_numpy, k=k + 1)
+        neighbors = torch.as_tensor(indices[:, k], device=coords.device)
+        distances = (u - u[neighbors]).norm(dim=-1).clamp(min=1e-12)
+
+        log_unit_volume = 0.5 * d * math.log(math.pi) - math.lgamma(0.5 * d + 1)
+        return (
+            torch.special.digamma(torch.tensor(float(n)))
+            - torch.special.digamma(torch.tensor(float(k)))
+            + log_unit_volume
+            + d * distances.log().mean()
+            + scale_tril.diagonal().log().sum()
+        )
+
+
+def sample_beam_and_entropy(beam, *conditions, entropy_fn=None):
+    """
+    Proposal beam and its entropy: `entropy_fn` of the beam if given (e.g.
+    `calculate_knn_entropy`), else the Monte Carlo estimate -E[log q] from
+    the same particles for beams with an exact density (`FlowTransform`),
+    else the entropy of a gaussian with the beam covariance.
+    """
+    if entropy_fn is None and getattr(beam, "has_density", False):
+        proposal_beam, log_prob = beam(*conditions, log_prob=True)
+        return proposal_beam, -log_prob.mean()
+
+    proposal_beam = beam(*conditions)
+    entropy_fn = entropy_fn or calculate_beam_entropy
+    return proposal_beam, entropy_fn(proposal_beam)
+
+
 # create data loader
 class ImageDataset(Dataset):
     def __init__(self, k, images):
@@ -195,6 +627,8 @@ def predict_images(beam, lattice, screen):
 
 
 class SextPhaseSpaceReconstructionModel(torch.nn.Module):
+    entropy_fn = None
+
     def __init__(self, lattice, diagnostic, beam):
         super(SextPhaseSpaceReconstructionModel, self).__init__()
 
@@ -215,16 +649,15 @@ class SextPhaseSpaceReconstructionModel(torch.nn.Module):
         return observations, final_beam
 
     def forward(self, params, ids):
-        proposal_beam = self.beam()
+        proposal_beam, entropy = sample_beam_and_entropy(
+            self.beam, entropy_fn=self.entropy_fn
+        )
 
         # track beam
         observations, final_beam = self.track_and_observe_beam(
             proposal_beam, params, ids
         )
 
-        # get entropy
-        entropy = calculate_beam_entropy(proposal_beam)
-
         # get beam covariance
         cov = calculate_covariance(proposal_beam)
 
@@ -232,6 +665,9 @@ class SextPhaseSpaceReconstructionModel(torch.nn.Module):
 
 
 class PhaseSpaceReconstructionModel3D(torch.nn.Module):
+    # entropy estimate of the proposal beam, see `sample_beam_and_entropy`
+    entropy_fn = None
+
     def __init__(self, lattice, diagnostic, beam):
         super(PhaseSpaceReconstructionModel3D, self).__init__()
 
@@ -253,8 +689,9 @@ class PhaseSpaceReconstructionModel3D(torch.nn.Module):
         lattice.elements[ids[2]].E2.data = theta
         lattice.elements[-1].L.data = 0.889 - l_bend / 2 / torch.cos(theta)
 
-        # track beam through lattice
-        final_beam = lattice(beam)
+        # track beam through lattice, always in full precision
+        with torch.autocast(beam.data.device.type, enabled=False):
+            final_beam = lattice(beam)
 
         # analyze beam with diagnostic
         observations = self.diagnostic(final_beam)
@@ -262,15 +699,36 @@ class PhaseSpaceReconstructionModel3D(torch.nn.Module):
         return observations, final_beam
 
     def forward(self, params, ids):
-        proposal_beam = self.beam()
+        proposal_beam, entropy = sample_beam_and_entropy(
+            self.beam, entropy_fn=self.entropy_fn
+        )
 
         # track beam
         observations, final_beam = self.track_and_observe_beam(
             proposal_beam, params, ids
         )
 
-        # get entropy
-        entropy = calculate_beam_entropy(proposal_beam)
+        # get beam covariance
+        cov = calculate_covariance(proposal_beam)
+
+        return observations, entropy, cov
+
+
+class ConditionalPhaseSpaceReconstructionModel3D(PhaseSpaceReconstructionModel3D):
+    """
+    3D scan model of a beam that depends on machine settings, with an
+    `InitialBeam` built on a `ConditionalNNTransform`.
+    """
+
+    def forward(self, params, ids, settings):
+        proposal_beam, entropy = sample_beam_and_entropy(
+            self.beam, settings, entropy_fn=self.entropy_fn
+        )
+
+        # track beam
+        observations, final_beam = self.track_and_observe_beam(
+            proposal_beam, params, ids
+        )
 
         # get beam covariance
         cov = calculate_covariance(proposal_beam)
@@ -294,7 +752,11 @@ class ImageDataset3D(Dataset):
 
 
 class PhaseSpaceReconstructionModel3D_2screens(torch.nn.Module):
-    def __init__(self, lattice0, lattice1, diagnostic0, diagnostic1, beam):
+    entropy_fn = None
+
+    def __init__(
+        self, lattice0, lattice1, diagnostic0, diagnostic1, beam, jitter=None
+    ):
         super(PhaseSpaceReconstructionModel3D_2screens, self).__init__()
 
         self.lattice0 = lattice0
@@ -302,8 +764,11 @@ class PhaseSpaceReconstructionModel3D_2screens(torch.nn.Module):
         self.diagnostic0 = diagnostic0
         self.diagnostic1 = diagnostic1
         self.beam = deepcopy(beam)
+        self.jitter = jitter
 
-    def track_and_observe_beam(self, beam, params, n_imgs_per_param, ids):
+    def track_and_observe_beam(
+        self, beam, params, n_imgs_per_param, ids, offsets=None
+    ):
         params_dipole_off = params[:, :, 0].unsqueeze(-1)
         diagnostics_lattice0 = self.lattice0.copy()
         diagnostics_lattice0.elements[ids[0]].K1.data = params_dipole_off[:, :, 0]
@@ -336,29 +801,38 @@ class PhaseSpaceReconstructionModel3D_2screens(torch.nn.Module):
         output_beam0 = diagnostics_lattice0(beam)
         output_beam1 = diagnostics_lattice1(beam)
 
-        # histograms at screens for dipole off(0) and dipole on (1)
-        images_dipole_off = self.diagnostic0(output_beam0).squeeze()
-        images_dipole_on = self.diagnostic1(output_beam1).squeeze()
+        # histograms at screens for dipole off(0) and dipole on (1), one
+        # image per shot for per-shot screen shifts
+        offsets0 = offsets1 = None
+        if offsets is not None:
+            offsets0, offsets1 = offsets[:, :, 0], offsets[:, :, 1]
+        images_dipole_off = self.diagnostic0(output_beam0, offsets0)
+        images_dipole_on = self.diagnostic1(output_beam1, offsets1)
 
         # stack on dipole dimension:
         images_stack = torch.stack((images_dipole_off, images_dipole_on), dim=2)
 
-        # create images copies simulating multi-shot per parameter config:
-        copied_images = torch.stack([images_stack] * n_imgs_per_param, dim=-3)
+        # without shifts a single image per parameter config, the loss
+        # broadcasts it against the shots
+        if offsets is None:
+            images_stack = images_stack.unsqueeze(-3)
+        return images_stack
 
-        return copied_images
+    def forward(self, params, n_imgs_per_param, ids, indices=None):
+        proposal_beam, entropy = sample_beam_and_entropy(
+            self.beam, entropy_fn=self.entropy_fn
+        )
 
-    def forward(self, params, n_imgs_per_param, ids):
-        proposal_beam = self.beam()
+        # per-shot jitter of the configurations `indices`, see `ShotJitter`
+        offsets = None
+        if getattr(self, "jitter", None) is not None:
+            offsets = self.jitter(indices)
 
         # track beam
         observations = self.track_and_observe_beam(
-            proposal_beam, params, n_imgs_per_param, ids
+            proposal_beam, params, n_imgs_per_param, ids, offsets
         )
 
-        # get entropy
-        entropy = calculate_beam_entropy(proposal_beam)
-
         # get beam covariance
         cov = calculate_covariance(proposal_beam)
 
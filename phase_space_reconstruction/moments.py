@@ -0,0 +1,173 @@
+import torch
+from bmadx.bmad_torch.track_torch import Beam
+
+from phase_space_reconstruction.modeling import (
+    InitialBeam,
+    NNTransform,
+    PhaseSpaceNormalization,
+    PhaseSpaceReconstructionModel3D,
+)
+from phase_space_reconstruction.utils import calculate_ellipse
+
+COORDINATES = ["x", "px", "y", "py", "z", "pz"]
+
+
+def transfer_matrices(lattice, params, ids, p0c, step=1e-6):
+    """
+    Linear transfer maps of the scan configurations `params`, from central
+    differences of particles tracked around the reference orbit.
+
+    Parameters
+    ----------
+    lattice: bmadx TorchLattice
+        6D diagnostics lattice with quadrupole, TDC and dipole
+
+    params: Tensor
+        scan parameters, shape [n_configs, 3, 1]
+
+    ids: list of ints
+        Indices of the elements to be scanned: [quad_id, tdc_id, dipole_id]
+
+    p0c: float
+        beam momentum
+
+    step: float
+        finite difference step in all coordinates. Default: 1e-6
+
+    Returns
+    -------
+    R: Tensor
+        transfer matrices, shape [n_configs, 6, 6]
+
+    offset: Tensor
+        final coordinates of the reference particle, shape [n_configs, 6]
+    """
+    steps = step * torch.eye(6)
+    coords = torch.cat((torch.zeros(1, 6), steps, -steps))
+    beam = Beam(coords, p0c=torch.tensor(p0c))
+
+    # track only, no screen images
+    scan_model = PhaseSpaceReconstructionModel3D(
+        lattice.copy(), lambda final_beam: None, None
+    )
+    with torch.no_grad():
+        _, final_beam = scan_model.track_and_observe_beam(beam, params, ids)
+
+    final = final_beam.data.reshape(len(params), 13, 6)
+    R = (final[:, 1:7] - final[:, 7:]).transpose(-2, -1) / (2 * step)
+    return R, final[:, 0]
+
+
+def fit_gaussian_moments(dset, lattice, screen, ids, p0c, step=1e-6, rcond=1e-6):
+    """
+    Least-squares estimate of the 6D centroid and covariance of a beam from
+    the centroids and second moments of the images of a 3D scan, see
+    `utils.calculate_ellipse`, and the linear transfer maps of the scan
+    configurations. The KDE bandwidth is subtracted from the image
+    variances and the covariance is projected onto the positive definite
+    matrices. Components the scan does not constrain, i.e. singular values
+    of the least-squares problem below `rcond` times the largest, are set
+    by the minimum norm solution.
+
+    Parameters
+    ----------
+    dset: ImageDataset3D
+        scan data with params [n_configs, 3, 1] and images [n_configs, 1, H, W]
+
+    lattice: bmadx TorchLattice
+        6D diagnostics lattice with quadrupole, TDC and dipole
+
+    screen: ImageDiagnostic
+        screen diagnostics the images were taken with
+
+    ids: list of ints
+        Indices of the elements to be scanned: [quad_id, tdc_id, dipole_id]
+
+    p0c: float
+        beam momentum
+
+    step: float
+        finite difference step of the transfer maps. Default: 1e-6
+
+    rcond: float
+        relative cutoff of the singular values. Default: 1e-6
+
+    Returns
+    -------
+    mean: Tensor
+        centroid, shape [6]
+
+    cov: Tensor
+        covariance matrix, shape [6, 6]
+    """
+    R, offset = transfer_matrices(lattice, dset.params, ids, p0c, step)
+    rows = [COORDINATES.index(screen.x), COORDINATES.index(screen.y)]
+    R, offset = R[:, rows].double(), offset[:, rows].double()
+
+    images = dset.images.reshape(len(dset.params), *dset.images.shape[-2:])
+    centroid, image_cov = calculate_ellipse(
+        images.transpose(-2, -1), screen.bins_x, screen.bins_y
+    )
+    centroid, image_cov = centroid.reshape(-1, 2).double(), image_cov.double()
+    image_cov = image_cov - screen.bandwidth.double() ** 2 * torch.eye(2).double()
+
+    # centroid: offset + R mean
+    mean = torch.linalg.lstsq(
+        R.reshape(-1, 6),
+        (centroid - offset).reshape(-1, 1),
+        rcond=rcond,
+        driver="gelsd",
+    ).solution.squeeze(-1)
+
+    # second moments: R cov R^T, unknowns are the upper triangle of cov
+    i, j = torch.triu_indices(6, 6)
+    design = torch.einsum("nai,nbj->nabij", R, R)
+    coefficients = design[..., i, j] + (i != j) * design[..., j, i]
+    a, b = torch.triu_indices(2, 2)
+    cov_triu = torch.linalg.lstsq(
+        coefficients[:, a, b].reshape(-1, len(i)),
+        image_cov[:, a, b].reshape(-1, 1),
+        rcond=rcond,
+        driver="gelsd",
+    ).solution.squeeze(-1)
+
+    cov = torch.zeros(6, 6).double()
+    cov[i, j] = cov_triu
+    cov[j, i] = cov_triu
+
+    # nearest positive definite matrix
+    eigenvalues, eigenvectors = torch.linalg.eigh(cov)
+    eigenvalues = eigenvalues.clamp(min=1e-6 * eigenvalues.max())
+    cov = eigenvectors @ torch.diag(eigenvalues) @ eigenvectors.T
+
+    return mean.float(), cov.float()
+
+
+def gaussian_warm_start(
+    dset, lattice, screen, ids, p0c, n_particles=10_000, nn_transform=None
+):
+    """
+    Reconstruction model that starts at the gaussian of
+    `fit_gaussian_moments`: a residual NN transform in phase space
+    coordinates normalized by the fitted moments. Its beam is a quick-look
+    reconstruction and the model can be refined with
+    `train.train_3d_scan(..., warm_start=model)`.
+
+    Parameters
+    ----------
+    n_particles: int
+        number of particles in the reconstructed beam
+
+    nn_transform: NNTransform or None
+        transformation in normalized coordinates. Default: residual NN with
+        2 hidden layers of width 20 and output scale 0.1
+    """
+    mean, cov = fit_gaussian_moments(dset, lattice, screen, ids, p0c)
+    beam = InitialBeam(
+        nn_transform or NNTransform(2, 20, output_scale=0.1, residual=True),
+        torch.distributions.MultivariateNormal(torch.zeros(6), torch.eye(6)),
+        n_particles,
+        normalization=PhaseSpaceNormalization.from_covariance(cov, mean),
+        p0c=torch.tensor(p0c),
+    )
+    return PhaseSpaceReconstructionModel3D(lattice.copy(), screen, beam)
@@ -0,0 +1,182 @@
+import math
+
+import torch
+
+from phase_space_reconstruction.losses import normalize_images
+
+
+def measurement_noise(images, shot_dim=-3, averaged=False):
+    """
+    Shot noise of measured images in the units of `losses.MAELoss`: the
+    mean absolute deviation of a normalized single-shot image from the
+    noise-free image, estimated from repeated shots.
+
+    Parameters
+    ----------
+    images: Tensor
+        images with a shot dimension, e.g. [..., n_shots, H, W] as in the
+        2 screen datasets
+
+    shot_dim: int
+        dimension of the repeated shots. Default: -3
+
+    averaged: bool
+        noise of the shot-averaged image instead, i.e. divided by
+        sqrt(n_shots). Default: False
+
+    Returns
+    -------
+    noise: float
+    """
+    n_shots = images.shape[shot_dim]
+    if n_shots < 2:
+        raise ValueError("the noise estimate needs at least 2 shots per image")
+
+    images = normalize_images(images)
+    deviation = images - images.mean(dim=shot_dim, keepdim=True)
+    # the shot mean absorbs part of the deviation of each shot
+    noise = deviation.abs().mean().item() * math.sqrt(n_shots / (n_shots - 1))
+    if averaged:
+        noise = noise / math.sqrt(n_shots)
+    return noise
+
+
+def model_image_noise(model, params, ids, n_particles, n_bootstrap=4):
+    """
+    Histogram noise of the images of a `PhaseSpaceReconstructionModel3D`
+    with `n_particles` particles, in the units of `measurement_noise`, from
+    `n_bootstrap` independent base beams freshly drawn from the base
+    distribution of the model beam, of any size. For two independent
+    images the mean absolute difference is sqrt(2) times the deviation of
+    each from the noise-free image.
+    """
+    beam = model.beam
+    base_beam, n_active = beam.base_beam, beam.n_active
+    beam.n_active = None
+    images = []
+    try:
+        with torch.no_grad():
+            for _ in range(n_bootstrap):
+                beam.set_base_beam(
+                    n_particles, p0c=base_beam.p0c, s=base_beam.s, mc2=base_beam.mc2
+                )
+                beam.base_beam = beam.base_beam.to(base_beam.data.device)
+                images.append(normalize_images(model(params, ids)[0]))
+    finally:
+        beam.base_beam, beam.n_active = base_beam, n_active
+
+    differences = [
+        (images[i] - images[j]).abs().mean()
+        for i in range(n_bootstrap)
+        for j in range(i + 1, n_bootstrap)
+    ]
+    return torch.stack(differences).mean().item() / math.sqrt(2)
+
+
+def recommend_n_particles(
+    model,
+    params,
+    ids,
+    noise,
+    ratio=1.0,
+    n_trials=(1_000, 4_000),
+    n_bootstrap=4,
+    min_particles=1_000,
+    max_particles=None,
+):
+    """
+    Smallest particle count whose model image noise is below `ratio` times
+    the measurement `noise`. The model noise is measured at the particle
+    counts `n_trials` and extrapolated with the 1 / sqrt(N) scaling of
+    histogram noise.
+
+    Parameters
+    ----------
+    model: PhaseSpaceReconstructionModel3D
+        current reconstruction
+
+    params: Tensor
+        scan parameters, shape [n_configs, 3, 1]
+
+    ids: list of ints
+        Indices of the elements to be scanned: [quad_id, tdc_id, dipole_id]
+
+    noise: float
+        measurement noise, see `measurement_noise`
+
+    ratio: float
+        target ratio of model to measurement noise. Default: 1
+
+    n_trials: tuple of ints
+        particle counts the model noise is measured at
+
+    min_particles, max_particles: int or None
+        bounds of the recommendation. Default: 1000, the base beam size
+
+    Returns
+    -------
+    n_particles: int
+    """
+    max_particles = max_particles or len(model.beam.base_beam.data)
+    # noise = c / sqrt(N)
+    c = sum(
+        model_image_noise(model, params, ids, n, n_bootstrap) * math.sqrt(n)
+        for n in n_trials
+    ) / len(n_trials)
+    n_particles = math.ceil((c / (ratio * noise)) ** 2)
+    return max(min_particles, min(n_particles, max_particles))
+
+
+class ParticleCountAdapter:
+    def __init__(
+        self,
+        noise,
+        ratio=1.0,
+        frequency=100,
+        n_trials=(1_000, 4_000),
+        n_bootstrap=4,
+        min_particles=1_000,
+    ):
+        """
+        Adapts the number of active particles during training to the
+        measurement noise, see `recommend_n_particles`. The recommendation
+        is updated every `frequency` epochs, since the histogram noise
+        changes with the reconstructed beam.
+
+        Parameters
+        ----------
+        noise: float
+            measurement noise, see `measurement_noise`
+
+        ratio: float
+            target ratio of model to measurement noise. Default: 1
+
+        frequency: int
+            epochs between updates. Default: 100
+        """
+        self.noise = noise
+        self.ratio = ratio
+        self.frequency = frequency
+        self.n_trials = n_trials
+        self.n_bootstrap = n_bootstrap
+        self.min_particles = min_particles
+
+        self.history = []
+
+    def n_particles(self, epoch, model, params, ids):
+        """Active particle count at `epoch`, at most the base beam size."""
+        if epoch % self.frequency == 0 or not self.history:
+            n_particles = recommend_n_particles(
+                model,
+                params,
+                ids,
+                self.noise,
+                self.ratio,
+                self.n_trials,
+                self.n_bootstrap,
+                self.min_particles,
+            )
+            self.history.append((epoch, n_particles))
+            print(f"epoch {epoch}: {n_particles} particles")
+
+        return self.history[-1][1]
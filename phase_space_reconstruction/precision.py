@@ -0,0 +1,104 @@
+import time
+
+import torch
+
+from phase_space_reconstruction.losses import MAELoss
+from phase_space_reconstruction.modeling import calculate_covariance
+
+
+def _forward(model, params, ids, target_images, dtype):
+    model.zero_grad()
+    start = time.perf_counter()
+    with torch.autocast("cpu", dtype=dtype, enabled=dtype is not None):
+        output = model(params, ids)
+    loss = MAELoss()(output, target_images)
+    if loss.requires_grad:
+        loss.backward()
+    elapsed = time.perf_counter() - start
+
+    with torch.no_grad(), torch.autocast("cpu", dtype=dtype, enabled=dtype is not None):
+        cov = calculate_covariance(model.beam())
+    grads = [p.grad.flatten() for p in model.parameters() if p.grad is not None]
+    grads = torch.cat(grads) if grads else torch.zeros(0)
+    model.zero_grad()
+
+    return output[0].detach(), cov, loss, grads, elapsed
+
+
+def precision_drift(model, params, ids, target_images=None, dtype=torch.bfloat16):
+    """
+    Numerical drift of a mixed precision training step against float32, for
+    the same model and base beam.
+
+    Parameters
+    ----------
+    model: PhaseSpaceReconstructionModel3D
+        model to evaluate, e.g. with a ground truth beam or a trained NN beam
+
+    params: Tensor
+        scan parameters, shape [n_configs, 3, 1]
+
+    ids: list of ints
+        Indices of the elements to be scanned: [quad_id, tdc_id, dipole_id]
+
+    target_images: Tensor or None
+        measured images for the loss and gradients. Default: the float32
+        predictions (zero loss, gradient drift is then not meaningful)
+
+    dtype: torch.dtype
+        autocast dtype. Default: torch.bfloat16
+
+    Returns
+    -------
+    dict with
+        image_l1: mean over configurations of sum |image - image_fp32|
+            (images have unit sum)
+        image_max: max |image - image_fp32| / max image_fp32
+        cov_rel: max |cov - cov_fp32| / max |cov_fp32| of the proposal beam
+        loss_fp32, loss: MAE loss in float32 and mixed precision
+        grad_cosine: cosine similarity of the parameter gradients
+        time_fp32, time: wall time (s) of forward + backward
+    """
+    with torch.no_grad():
+        reference = model(params, ids)[0]
+    if target_images is None:
+        target_images = reference
+
+    images_fp32, cov_fp32, loss_fp32, grads_fp32, time_fp32 = _forward(
+        model, params, ids, target_images, None
+    )
+    images, cov, loss, grads, elapsed = _forward(
+        model, params, ids, target_images, dtype
+    )
+
+    image_l1 = (images - images_fp32).abs().sum(dim=(-2, -1)).mean()
+    image_max = (images - images_fp32).abs().max() / images_fp32.max()
+    cov_rel = (cov - cov_fp32).abs().max() / cov_fp32.abs().max()
+    if len(grads):
+        grad_cosine = torch.nn.functional.cosine_similarity(
+            grads, grads_fp32, dim=0
+        ).item()
+    else:
+        grad_cosine = float("nan")
+
+    return {
+        "image_l1": image_l1.item(),
+        "image_max": image_max.item(),
+        "cov_rel": cov_rel.item(),
+        "loss_fp32": loss_fp32.item(),
+        "loss": loss.item(),
+        "grad_cosine": grad_cosine,
+        "time_fp32": time_fp32,
+        "time": elapsed,
+    }
+
+
+def print_precision_drift(report, name=""):
+    print(
+        f"{name} image L1 {report['image_l1']:.2e}, "
+        f"max pixel {report['image_max']:.2e}, "
+        f"cov {report['cov_rel']:.2e}, "
+        f"loss {report['loss_fp32']:.4e} -> {report['loss']:.4e}, "
+        f"grad cosine {report['grad_cosine']:.4f}, "
+        f"time {report['time_fp32']:.3f}s -> {report['time']:.3f}s"
+    )
@@ -0,0 +1,116 @@
+import math
+
+import torch
+from torch.utils.data import Sampler
+
+
+class PrioritizedConfigSampler(Sampler):
+    def __init__(
+        self,
+        n_configs,
+        batch_size,
+        n_batches=None,
+        alpha=1.0,
+        beta=1.0,
+        smoothing=0.9,
+        uniform_fraction=0.1,
+        seed=None,
+    ):
+        """
+        Samples batches of scan configurations in proportion to a running
+        per-configuration loss, so that well fitted configurations are
+        evaluated less often. Every yielded batch is a tensor of indices,
+        drawn with replacement with probabilities
+
+            p_i = (1 - u) * l_i**alpha / sum_j l_j**alpha + u / n_configs,
+
+        where l_i is an exponential moving average of the loss of
+        configuration i and u the `uniform_fraction`. Weighting the
+        per-configuration losses of a batch with `weights` keeps the mean
+        an unbiased estimate of the loss averaged over all configurations.
+
+        Parameters
+        ----------
+        n_configs: int
+            number of scan configurations in the dataset
+
+        batch_size: int
+            configurations per batch
+
+        n_batches: int or None
+            batches per epoch. Default: as many as a uniform epoch,
+            ceil(n_configs / batch_size)
+
+        alpha: float
+            priority exponent, 0 is uniform sampling. Default: 1
+
+        beta: float
+            importance weight exponent, 1 is fully unbiased. Default: 1
+
+        smoothing: float
+            moving average factor of the running losses. Default: 0.9
+
+        uniform_fraction: float
+            probability mass spread uniformly over all configurations, which
+            bounds the importance weights. Default: 0.1
+
+        seed: int or None
+            seed of the sampling generator
+        """
+        self.n_configs = n_configs
+        self.batch_size = batch_size
+        self.n_batches = n_batches or math.ceil(n_configs / batch_size)
+        self.alpha = alpha
+        self.beta = beta
+        self.smoothing = smoothing
+        self.uniform_fraction = uniform_fraction
+
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+
+        # unseen configurations share the largest running loss
+        self.running_loss = torch.ones(n_configs)
+        self.seen = torch.zeros(n_configs, dtype=torch.bool)
+
+    def __len__(self):
+        return self.n_batches
+
+    def __iter__(self):
+        for _ in range(self.n_batches):
+            yield torch.multinomial(
+                self.probabilities(),
+                self.batch_size,
+                replacement=True,
+                generator=self.generator,
+            )
+
+    def probabilities(self):
+        running_loss = self.running_loss.clone()
+        if self.seen.any():
+            running_loss[~self.seen] = running_loss[self.seen].max()
+
+        priorities = running_loss.clamp(min=1e-12) ** self.alpha
+        priorities = priorities / priorities.sum()
+        return (1 - self.uniform_fraction) * priorities + (
+            self.uniform_fraction / self.n_configs
+        )
+
+    def weights(self, indices):
+        """Importance weights of the configurations `indices`."""
+        probabilities = self.probabilities()[indices.cpu()]
+        return ((self.n_configs * probabilities) ** -self.beta).to(indices.device)
+
+    def update(self, indices, losses):
+        """Updates the running losses with per-configuration `losses`."""
+        indices = indices.cpu()
+        losses = losses.detach().float().cpu()
+        for index, loss in zip(indices.tolist(), losses):
+            if self.seen[index]:
+                self.running_loss[index] = (
+                    self.smoothing * self.running_loss[index]
+                    + (1 - self.smoothing) * loss
+                )
+            else:
+                self.running_loss[index] = loss
+                self.seen[index] = True
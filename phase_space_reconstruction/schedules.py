@@ -0,0 +1,116 @@
+import torch.nn.functional as F
+
+from phase_space_reconstruction.diagnostics import ImageDiagnostic
+
+
+def downsample_images(images, factor):
+    """
+    Sums `factor` x `factor` pixel blocks of images with shape [..., H, W].
+    Trailing rows and columns that do not fill a block are dropped, as in
+    `downsample_bins`.
+    """
+    if factor == 1:
+        return images
+
+    shape = images.shape
+    pooled = F.avg_pool2d(images.reshape(-1, 1, *shape[-2:]), factor) * factor**2
+    return pooled.reshape(*shape[:-2], *pooled.shape[-2:])
+
+
+def downsample_bins(bins, factor):
+    """Pixel centers of `factor` x coarser bins."""
+    n = len(bins) // factor * factor
+    return bins[:n].reshape(-1, factor).mean(dim=-1)
+
+
+class CoarseToFineSchedule:
+    def __init__(
+        self,
+        full_fidelity_epoch,
+        particle_fraction=0.1,
+        downsample=4,
+        bandwidth_scale=None,
+    ):
+        """
+        Training schedule that starts with a random subset of the base beam
+        particles, downsampled images and a wide KDE bandwidth, and ramps all
+        three to full fidelity at `full_fidelity_epoch`.
+
+        The particle count grows geometrically every epoch. Image resolution
+        doubles in equally spaced stages, from `downsample` times coarser
+        bins to the full screen, and the bandwidth scale shrinks with it.
+
+        Parameters
+        ----------
+        full_fidelity_epoch: int
+            first epoch at full particle count, resolution and bandwidth
+
+        particle_fraction: float
+            fraction of the base beam used at epoch 0. Default: 0.1
+
+        downsample: int
+            image downsampling factor at epoch 0, preferably a power of 2.
+            Default: 4
+
+        bandwidth_scale: float or None
+            bandwidth multiplier at epoch 0. Default: `downsample`, i.e. the
+            bandwidth keeps the same ratio to the coarse pixel size
+        """
+        self.full_fidelity_epoch = full_fidelity_epoch
+        self.particle_fraction = particle_fraction
+        self.downsample = downsample
+        if bandwidth_scale is None:
+            bandwidth_scale = downsample
+        self.bandwidth_scale = bandwidth_scale
+
+        self._screens = {}
+
+    def progress(self, epoch):
+        """Fraction of the ramp completed at `epoch`, between 0 and 1."""
+        if self.full_fidelity_epoch <= 0:
+            return 1.0
+        return min(epoch / self.full_fidelity_epoch, 1.0)
+
+    def n_particles(self, epoch, n_particles):
+        fraction = self.particle_fraction ** (1 - self.progress(epoch))
+        return max(1, min(n_particles, int(round(fraction * n_particles))))
+
+    def stage(self, epoch):
+        """Resolution stage, from 0 (coarsest) to `n_stages` (full)."""
+        return int(self.progress(epoch) * self.n_stages)
+
+    @property
+    def n_stages(self):
+        return max(self.downsample.bit_length() - 1, 0)
+
+    def downsample_factor(self, epoch):
+        return max(1, self.downsample // 2 ** self.stage(epoch))
+
+    def bandwidth_factor(self, epoch):
+        if self.n_stages == 0:
+            return 1.0
+        return self.bandwidth_scale ** (1 - self.stage(epoch) / self.n_stages)
+
+    def screen(self, epoch, screen):
+        """
+        Screen with the bins and bandwidth of `epoch`. Coarse screens are
+        cached, the full fidelity stage returns `screen` itself.
+        """
+        factor = self.downsample_factor(epoch)
+        bandwidth_factor = self.bandwidth_factor(epoch)
+        if factor == 1 and bandwidth_factor == 1.0:
+            return screen
+
+        key = (id(screen), factor, bandwidth_factor)
+        if key not in self._screens:
+            self._screens[key] = ImageDiagnostic(
+                downsample_bins(screen.bins_x, factor),
+                downsample_bins(screen.bins_y, factor),
+                screen.bandwidth * bandwidth_factor,
+                x=screen.x,
+                y=screen.y,
+                normalize=screen.normalize,
+                kernel_dtype=screen.kernel_dtype,
+            )
+
+        return self._screens[key]
@@ -0,0 +1,171 @@
+import os
+import re
+from collections.abc import Mapping
+
+import torch
+
+from phase_space_reconstruction.modeling import (
+    ConditionalNNTransform,
+    FlowTransform,
+    InitialBeam,
+    NNTransform,
+    PhaseSpaceNormalization,
+)
+
+TRANSFORMERS = {"NNTransform": NNTransform, "FlowTransform": FlowTransform}
+
+
+def _transformer_config(transformer):
+    """Class name and constructor arguments of a transformer."""
+    if isinstance(transformer, NNTransform):
+        stack = transformer.stack
+        return "NNTransform", {
+            "n_hidden": (len(stack) - 3) // 3,
+            "width": stack[0].out_features,
+            "activation": type(stack[1]).__name__,
+            "phase_space_dim": stack[0].in_features,
+            "residual": getattr(transformer, "residual", False),
+        }
+    if isinstance(transformer, FlowTransform):
+        stack = transformer.layers[0].stack
+        return "FlowTransform", {
+            "n_layers": len(transformer.layers),
+            "width": stack[0].out_features,
+            "n_hidden": (len(stack) - 3) // 2,
+            "activation": type(stack[1]).__name__,
+            "phase_space_dim": len(transformer.layers[0].mask),
+        }
+    if isinstance(transformer, ConditionalNNTransform):
+        raise ValueError(
+            "conditional beams are not supported, their particles depend on "
+            "the machine settings"
+        )
+    raise ValueError(f"unsupported transformer {type(transformer).__name__}")
+
+
+def _cpu_state_dict(module):
+    return {name: value.detach().cpu() for name, value in module.state_dict().items()}
+
+
+def save_snapshot(beam, fname, seed=0, **metadata):
+    """
+    Saves a generative snapshot of an `InitialBeam`: the weights and
+    constructor arguments of the transformer, the base distribution and the
+    normalization together with a base beam seed and `metadata` (e.g.
+    epoch, default particle count), a few kilobytes instead of a particle
+    dump. Load with `load_snapshot`.
+
+    Parameters
+    ----------
+    beam: InitialBeam
+        beam to save, with an `NNTransform` or `FlowTransform` and a
+        `MultivariateNormal` base distribution
+
+    fname: str
+        output file
+
+    seed: int
+        seed of the base beam the particles are regenerated from. Default: 0
+    """
+    name, config = _transformer_config(beam.transformer)
+    if not isinstance(beam.base_dist, torch.distributions.MultivariateNormal):
+        raise ValueError("the base distribution must be a MultivariateNormal")
+
+    base_beam = beam.base_beam
+    normalization = beam.normalization
+    torch.save(
+        {
+            "transformer": name,
+            "transformer_config": config,
+            "transformer_state": _cpu_state_dict(beam.transformer),
+            "base_loc": beam.base_dist.loc.detach().cpu(),
+            "base_scale_tril": beam.base_dist.scale_tril.detach().cpu(),
+            "normalization": None
+            if normalization is None
+            else _cpu_state_dict(normalization),
+            "p0c": base_beam.p0c.detach().cpu(),
+            "s": base_beam.s.detach().cpu(),
+            "mc2": base_beam.mc2.detach().cpu(),
+            "seed": seed,
+            "metadata": metadata,
+        },
+        fname,
+    )
+
+
+class GenerativeSnapshot:
+    def __init__(self, state):
+        """
+        Beam saved by `save_snapshot`. Particles are generated on demand by
+        `beam`, the same particle count always gives the same particles.
+        """
+        config = dict(state["transformer_config"])
+        config["activation"] = getattr(torch.nn, config["activation"])()
+        self.transformer = TRANSFORMERS[state["transformer"]](**config)
+        self.transformer.load_state_dict(state["transformer_state"])
+        self.transformer.eval()
+
+        self.base_dist = torch.distributions.MultivariateNormal(
+            state["base_loc"], scale_tril=state["base_scale_tril"]
+        )
+        self.normalization = None
+        if state["normalization"] is not None:
+            self.normalization = PhaseSpaceNormalization(
+                state["normalization"]["mean"], state["normalization"]["scale_tril"]
+            )
+        self.p0c = state["p0c"]
+        self.s = state["s"]
+        self.mc2 = state["mc2"]
+        self.seed = state["seed"]
+        self.metadata = state["metadata"]
+
+    def beam(self, n_particles=None):
+        """
+        Regenerated beam of `n_particles`. Default: the `n_particles` of the
+        metadata.
+        """
+        n_particles = n_particles or self.metadata["n_particles"]
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(self.seed)
+            initial_beam = InitialBeam(
+                self.transformer,
+                self.base_dist,
+                n_particles,
+                normalization=self.normalization,
+                p0c=self.p0c,
+                s=self.s,
+                mc2=self.mc2,
+            )
+        with torch.no_grad():
+            return initial_beam().detach_clone()
+
+
+def load_snapshot(fname):
+    """Loads a snapshot written by `save_snapshot`."""
+    return GenerativeSnapshot(torch.load(fname, weights_only=True))
+
+
+class SnapshotSeries(Mapping):
+    def __init__(self, save_dir):
+        """
+        Lazy mapping epoch -> `GenerativeSnapshot` of the snapshots a
+        trainer wrote to `save_dir`. Files are read on first access.
+        """
+        self.files = {}
+        for name in os.listdir(save_dir):
+            match = re.fullmatch(r"snapshot_(\d+)\.pt", name)
+            if match:
+                self.files[int(match.group(1))] = os.path.join(save_dir, name)
+        self.files = dict(sorted(self.files.items()))
+        self._snapshots = {}
+
+    def __getitem__(self, epoch):
+        if epoch not in self._snapshots:
+            self._snapshots[epoch] = load_snapshot(self.files[epoch])
+        return self._snapshots[epoch]
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
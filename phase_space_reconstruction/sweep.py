@@ -0,0 +1,317 @@
+import hashlib
+import itertools
+import json
+import math
+import os
+
+import numpy as np
+import torch
+
+from phase_space_reconstruction.diagnostics import ImageDiagnostic
+from phase_space_reconstruction.ensemble import (
+    available_cores,
+    pinned_pool,
+    share_dataset,
+)
+from phase_space_reconstruction.losses import MAELoss
+from phase_space_reconstruction.modeling import NNTransform
+from phase_space_reconstruction.telemetry import TrainingTelemetry
+from phase_space_reconstruction.train import train_3d_scan
+
+# config keys that are not trainer arguments
+NN_KEYS = ("n_hidden", "width", "output_scale")
+
+
+def grid_configs(search_space):
+    """
+    All combinations of a grid search space.
+
+    Parameters
+    ----------
+    search_space: dict
+        parameter name -> list of values
+
+    Returns
+    -------
+    list of dicts
+    """
+    names = list(search_space)
+    return [
+        dict(zip(names, values))
+        for values in itertools.product(*[search_space[name] for name in names])
+    ]
+
+
+def random_configs(search_space, n_trials, seed=0):
+    """
+    Random samples of a search space.
+
+    Parameters
+    ----------
+    search_space: dict
+        parameter name -> list of values (sampled uniformly) or a
+        distribution with an `rvs` method, e.g. `scipy.stats.loguniform`
+
+    n_trials: int
+        number of configurations
+
+    seed: int
+        random seed
+
+    Returns
+    -------
+    list of dicts
+    """
+    rng = np.random.default_rng(seed)
+    configs = []
+    for _ in range(n_trials):
+        config = {}
+        for name, space in search_space.items():
+            if hasattr(space, "rvs"):
+                config[name] = float(space.rvs(random_state=rng))
+            else:
+                config[name] = space[rng.integers(len(space))]
+        configs.append(config)
+
+    return configs
+
+
+def dataset_hash(*dsets):
+    """sha256 of the params and images of scan datasets."""
+    h = hashlib.sha256()
+    for dset in dsets:
+        for tensor in (dset.params, dset.images):
+            h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+
+    return h.hexdigest()
+
+
+def trial_key(data_hash, config, n_epochs, seed=0):
+    """
+    Cache key of a configuration trained for `n_epochs` with random seed
+    `seed` on hashed data.
+    """
+    h = hashlib.sha256(data_hash.encode())
+    h.update(json.dumps(config, sort_keys=True, default=str).encode())
+    h.update(str(n_epochs).encode())
+    h.update(str(seed).encode())
+    return h.hexdigest()[:32]
+
+
+def config_to_kwargs(config, screen=None):
+    """
+    Converts a sweep configuration to trainer keyword arguments: `n_hidden`,
+    `width` and `output_scale` build the `nn_transform`, `bandwidth` replaces
+    the bandwidth of a copy of `screen` (same bins, axes, normalization and
+    kernel dtype), everything else is passed through.
+    """
+    kwargs = {k: v for k, v in config.items() if k not in NN_KEYS + ("bandwidth",)}
+
+    if any(k in config for k in NN_KEYS):
+        kwargs["nn_transform"] = NNTransform(
+            config.get("n_hidden", 2),
+            config.get("width", 20),
+            output_scale=config.get("output_scale", 1e-3),
+        )
+
+    if "bandwidth" in config:
+        kwargs["screen"] = ImageDiagnostic(
+            screen.bins_x,
+            screen.bins_y,
+            torch.tensor(config["bandwidth"]),
+            x=screen.x,
+            y=screen.y,
+            normalize=screen.normalize,
+            kernel_dtype=screen.kernel_dtype,
+        )
+
+    return kwargs
+
+
+def validation_loss(model, val_dset, ids):
+    """MAE loss of a `PhaseSpaceReconstructionModel3D` on a held out scan."""
+    model.eval()
+    with torch.no_grad():
+        output = model(val_dset.params, ids)
+        loss = MAELoss()(output, val_dset.images).item()
+    model.train()
+
+    return loss
+
+
+def _run_rung(task):
+    train_fn, config, train_kwargs, n_epochs, warm_start, fname, seed = task
+
+    kwargs = {**train_kwargs, **config_to_kwargs(config, train_kwargs["screen"])}
+    kwargs.setdefault("telemetry", TrainingTelemetry(print_frequency=0))
+    val_dset = kwargs.pop("val_dset")
+    if warm_start is not None:
+        kwargs["warm_start"] = warm_start
+
+    # same random draws (base beam, batches) for every configuration
+    torch.manual_seed(seed)
+    _, model = train_fn(n_epochs=n_epochs, **kwargs)
+    val_loss = validation_loss(model, val_dset, kwargs["ids"])
+
+    torch.save(model, fname + ".pt")
+    with open(fname + ".json", "w") as f:
+        json.dump({"config": config, "val_loss": val_loss}, f)
+
+    return val_loss
+
+
+def run_sweep(
+    train_dset,
+    val_dset,
+    search_space,
+    cache_dir,
+    train_fn=train_3d_scan,
+    search="grid",
+    n_trials=None,
+    min_epochs=100,
+    max_epochs=3000,
+    eta=3,
+    n_workers=None,
+    threads_per_worker=None,
+    seed=0,
+    **train_kwargs,
+):
+    """
+    Hyperparameter sweep with successive halving. All configurations are
+    trained for `min_epochs`, evaluated on `val_dset`, and the best `1/eta`
+    continue (warm-started from their previous weights) for `eta` times as
+    many epochs, until `max_epochs`. Trials run in parallel on a pool of
+    workers pinned to disjoint CPU cores.
+
+    Only the model weights carry over between rungs: every rung starts a
+    new optimizer, so the Adam moments and the learning rate decay of
+    `use_decay` restart from scratch. Every rung is seeded with `seed`, so
+    configurations are compared on the same random draws and each trial can
+    be reproduced.
+
+    Every (configuration, epochs) result is cached in `cache_dir` under a
+    hash of the datasets and the configuration, so rerunning a sweep only
+    trains what is new. The key does not cover `train_kwargs`: use a new
+    `cache_dir` when changing the lattice, screen or other fixed arguments.
+
+    Parameters
+    ----------
+    train_dset: ImageDataset3D
+        training data
+
+    val_dset: ImageDataset3D
+        held out scan used to rank configurations
+
+    search_space: dict
+        parameter name -> values. Trainer arguments (e.g. `lr`, `use_decay`)
+        plus `n_hidden`, `width`, `output_scale` of the `NNTransform` and the
+        screen `bandwidth`, see `config_to_kwargs`
+
+    cache_dir: str
+        directory for cached trial results
+
+    train_fn: callable
+        trainer supporting `warm_start` and returning (beam, model).
+        Default: `train_3d_scan`
+
+    search: 'grid' or 'random'
+        how configurations are drawn from `search_space`, see `grid_configs`
+        and `random_configs`
+
+    n_trials: int or None
+        number of configurations for random search, required with
+        `search="random"`
+
+    min_epochs: int
+        epochs of the first rung
+
+    max_epochs: int
+        epochs of the final rung
+
+    eta: int
+        halving rate
+
+    seed: int
+        seed of the random search and of the trials. Default: 0
+
+    train_kwargs:
+        fixed trainer arguments (`lattice`, `p0c`, `screen`, `ids`, ...)
+
+    Returns
+    -------
+    list of dicts with 'config', 'n_epochs', 'val_loss' and 'model' (path),
+    for the last rung each configuration reached, best first
+    """
+    if search == "grid":
+        configs = grid_configs(search_space)
+    elif search == "random":
+        if n_trials is None:
+            raise ValueError("random search needs n_trials")
+        configs = random_configs(search_space, n_trials, seed)
+    else:
+        raise ValueError(f"unknown search '{search}'")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    data_hash = dataset_hash(train_dset, val_dset)
+    train_kwargs = {
+        **train_kwargs,
+        "train_dset": share_dataset(train_dset),
+        "val_dset": share_dataset(val_dset),
+    }
+
+    n_workers = n_workers or min(len(configs), len(available_cores()))
+    results = {i: None for i in range(len(configs))}
+    survivors = list(range(len(configs)))
+    n_epochs, previous_epochs = min_epochs, 0
+
+    with pinned_pool(n_workers, threads_per_worker) as pool:
+        while True:
+            # train (or load from cache) every surviving configuration
+            tasks = []
+            for i in survivors:
+                fname = os.path.join(
+                    cache_dir, trial_key(data_hash, configs[i], n_epochs, seed)
+                )
+                if os.path.exists(fname + ".json"):
+                    continue
+
+                warm_start = results[i]["model"] if results[i] else None
+                tasks.append(
+                    (
+                        train_fn,
+                        configs[i],
+                        train_kwargs,
+                        n_epochs - previous_epochs,
+                        warm_start,
+                        fname,
+                        seed,
+                    )
+                )
+
+            pool.map(_run_rung, tasks, chunksize=1)
+
+            for i in survivors:
+                fname = os.path.join(
+                    cache_dir, trial_key(data_hash, configs[i], n_epochs, seed)
+                )
+                with open(fname + ".json") as f:
+                    val_loss = json.load(f)["val_loss"]
+                results[i] = {
+                    "config": configs[i],
+                    "n_epochs": n_epochs,
+                    "val_loss": val_loss,
+                    "model": fname + ".pt",
+                }
+
+            if n_epochs >= max_epochs:
+                break
+
+            # keep the best 1 / eta
+            survivors = sorted(survivors, key=lambda i: results[i]["val_loss"])
+            survivors = survivors[: max(1, math.ceil(len(survivors) / eta))]
+            previous_epochs, n_epochs = n_epochs, min(n_epochs * eta, max_epochs)
+
+    return sorted(
+        results.values(),
+        key=lambda r: (-r["n_epochs"], r["val_loss"]),
+    )
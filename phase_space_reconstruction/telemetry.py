@@ -0,0 +1,255 @@
+import json
+import os
+import resource
+import sys
+import time
+
+from torch.profiler import profile, ProfilerActivity
+
+from phase_space_reconstruction.diagnostics import ImageDiagnostic
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+class TrainingTelemetry:
+    def __init__(
+        self,
+        log_file=None,
+        print_frequency=100,
+        profile_epochs=None,
+        profile_dir=".",
+    ):
+        """
+        Records per-step timings of the training loop and streams them to a
+        JSONL file, one record per optimizer step plus one per epoch.
+
+        Step records hold the wall time (s) of beam sampling
+        (`InitialBeam.forward`), tracking, diagnostic histograms, loss,
+        backward and optimizer step, together with particles/s,
+        configurations/s and the peak RSS. Sampling and histogram times are
+        measured with forward hooks on the model, tracking is the rest of the
+        model forward pass marked by the trainer. Epoch records hold the loss,
+        learning rates and the wall time since training started, see
+        `time_to_loss`.
+
+        Parameters
+        ----------
+        log_file : str, optional
+            JSONL output file. Default: None (no file)
+
+        print_frequency : int, optional
+            print the loss every `print_frequency` epochs, 0 to disable.
+            Default: 100
+
+        profile_epochs : tuple of ints, optional
+            (first, last) epochs to run under `torch.profiler`. The chrome
+            trace is written to `profile_dir`. Default: None
+
+        profile_dir : str, optional
+            output directory for profiler traces. Default: '.'
+        """
+        self.log_file = log_file
+        self.print_frequency = print_frequency
+        self.profile_epochs = profile_epochs
+        self.profile_dir = profile_dir
+
+        self._file = None
+        self._handles = []
+        self._profiler = None
+        self._n_particles = None
+        self._epoch = 0
+        self._step = 0
+        self._hook_starts = {}
+        self._stages = {}
+        self._last_mark = None
+        self._step_start = None
+        self._start = None
+        self._excluded = 0.0
+
+    def attach(self, model, hooks=True):
+        """
+        Registers timing hooks on the beam and diagnostics of `model`. Without
+        hooks (e.g. for compiled models) the whole forward pass is reported
+        as tracking. Call again after replacing a diagnostic of the model.
+        Models without a particle beam, e.g. a `GaussianMixtureBeam`, report
+        the forward pass only.
+        """
+        self._remove_hooks()
+        if self.log_file is not None and self._file is None:
+            self._file = open(self.log_file, "a", buffering=1)
+        if self._start is None:
+            self._start = time.perf_counter()
+            self._excluded = 0.0
+
+        model = getattr(model, "module", model)
+        if not hasattr(model, "beam"):
+            self._n_particles = None
+            return self
+
+        if hooks:
+            self._handles += self._time_module(model.beam, "sampling")
+            for module in model.modules():
+                if isinstance(module, ImageDiagnostic):
+                    self._handles += self._time_module(module, "histogram")
+
+        self._n_particles = lambda: getattr(model.beam, "n_active", None) or len(
+            model.beam.base_beam.data
+        )
+        return self
+
+    def detach(self):
+        self._remove_hooks()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._start = None
+
+    def _remove_hooks(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def _time_module(self, module, stage):
+        # closures rather than bound methods, the models deepcopy submodules
+        starts = self._hook_starts
+        stages = self._stages
+
+        def pre_hook(module, args):
+            starts[stage] = time.perf_counter()
+
+        def post_hook(module, args, output):
+            elapsed = time.perf_counter() - starts[stage]
+            stages[stage] = stages.get(stage, 0.0) + elapsed
+
+        return [
+            module.register_forward_pre_hook(pre_hook),
+            module.register_forward_hook(post_hook),
+        ]
+
+    def start_epoch(self, epoch):
+        self._epoch = epoch
+        if self.profile_epochs is not None and epoch == self.profile_epochs[0]:
+            self._profiler = profile(
+                activities=[ProfilerActivity.CPU], profile_memory=True
+            )
+            self._profiler.__enter__()
+
+    def start_step(self):
+        self._stages.clear()
+        self._step_start = self._last_mark = time.perf_counter()
+
+    def mark(self, stage):
+        """Records the time since the previous mark as `stage`."""
+        now = time.perf_counter()
+        self._stages[stage] = self._stages.get(stage, 0.0) + now - self._last_mark
+        self._last_mark = now
+
+    def end_step(self, n_configs):
+        """Closes the step, the time since the last mark is the optimizer step."""
+        self.mark("optimizer")
+        step_time = self._last_mark - self._step_start
+
+        # split the model forward pass into sampling / tracking / histogram
+        stages = dict(self._stages)
+        forward = stages.pop("forward", 0.0)
+        stages["tracking"] = forward - stages.get("sampling", 0.0) - stages.get(
+            "histogram", 0.0
+        )
+
+        n_particles = self._n_particles() if self._n_particles else 0
+        record = {
+            "epoch": self._epoch,
+            "step": self._step,
+            "step_time": step_time,
+            **stages,
+            "n_configs": n_configs,
+            "n_particles": n_particles,
+            "particles_per_s": n_particles * n_configs / step_time,
+            "configs_per_s": n_configs / step_time,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        self._step += 1
+        self._write(record)
+        return record
+
+    def end_epoch(self, epoch, loss, optimizer=None, eval_loss=None, eval_time=0.0):
+        """
+        Logs the epoch record. An `eval_loss` (e.g. the full-batch loss) is
+        logged next to the training loss, the `eval_time` spent on it is
+        excluded from the wall time of this and all later records. The
+        loss is None if no step has been accepted yet, e.g. after a rollback
+        by `DivergenceGuard`.
+        """
+        if self.print_frequency and epoch % self.print_frequency == 0:
+            print(epoch, loss)
+
+        self._excluded += eval_time
+        record = {
+            "epoch": epoch,
+            "loss": None if loss is None else loss.detach().mean().item(),
+            "time": time.perf_counter() - self._start - self._excluded,
+        }
+        if eval_loss is not None:
+            record["eval_loss"] = eval_loss.detach().mean().item()
+        if optimizer is not None:
+            record["lr"] = [group["lr"] for group in optimizer.param_groups]
+        self._write(record)
+
+        if self._profiler is not None and epoch == self.profile_epochs[1]:
+            self._profiler.__exit__(None, None, None)
+            os.makedirs(self.profile_dir, exist_ok=True)
+            self._profiler.export_chrome_trace(
+                os.path.join(
+                    self.profile_dir,
+                    f"trace_{self.profile_epochs[0]}_{self.profile_epochs[1]}.json",
+                )
+            )
+            self._profiler = None
+
+    def event(self, record):
+        """Logs an event record, e.g. a rollback by `DivergenceGuard`."""
+        self._write(record)
+
+    def _write(self, record):
+        if self._file is not None:
+            self._file.write(json.dumps(record) + "\n")
+
+
+def time_to_loss(log_file, loss, min_epoch=0, key="loss"):
+    """
+    Wall time (s) from the start of training until the epoch loss logged in
+    `log_file` first reaches `loss`, or None if it never does.
+
+    Parameters
+    ----------
+    log_file: str
+        JSONL file written by `TrainingTelemetry`
+
+    loss: float
+        target loss
+
+    min_epoch: int
+        ignore earlier epochs, e.g. the coarse epochs of a
+        `CoarseToFineSchedule`, whose losses are not computed on the full
+        resolution images. Default: 0
+
+    key: str
+        loss of the epoch records to compare, e.g. 'eval_loss' of
+        `train.train_3d_scan(..., eval_loss=True)`. Default: 'loss'
+    """
+    with open(log_file) as f:
+        for line in f:
+            record = json.loads(line)
+            # step records time the loss, epoch records hold its value
+            if "step" in record or "event" in record:
+                continue
+            if record["epoch"] >= min_epoch:
+                if record[key] is not None and record[key] <= loss:
+                    return record["time"]
+
+    return None
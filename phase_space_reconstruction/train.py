@@ -1,12 +1,20 @@
 import copy
 import os
+import time
 
 import torch
 from torch.optim.lr_scheduler import ExponentialLR
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, TensorDataset
 
+from phase_space_reconstruction.beams.parameteric_models import GaussianMixtureBeam
+from phase_space_reconstruction.compilation import (
+    compile_prediction,
+    compile_training_step,
+)
 from phase_space_reconstruction.losses import MENTLoss, MAELoss
 from phase_space_reconstruction.modeling import (
+    ConditionalNNTransform,
+    ConditionalPhaseSpaceReconstructionModel3D,
     ImageDataset,
     ImageDataset3D,
     InitialBeam,
@@ -15,7 +23,79 @@ from phase_space_reconstruction.modeling import (
     PhaseSpaceReconstructionModel3D,
     PhaseSpaceReconstructionModel3D_2screens,
     SextPhaseSpaceReconstructionModel,
+    ShotJitter,
+)
+from phase_space_reconstruction.moments import (
+    fit_gaussian_moments,
+    transfer_matrices,
 )
+from phase_space_reconstruction.sampling import PrioritizedConfigSampler
+from phase_space_reconstruction.schedules import downsample_images
+from phase_space_reconstruction.snapshots import save_snapshot
+from phase_space_reconstruction.telemetry import TrainingTelemetry
+
+
+def save_checkpoint(model, optimizer, fname):
+    """
+    Saves a trained model together with its optimizer state, so that a
+    later reconstruction can be warm-started from it.
+
+    Parameters
+    ----------
+    model: PhaseSpaceReconstructionModel3D or PhaseSpaceReconstructionModel3D_2screens
+        trained model
+
+    optimizer: torch.optim.Optimizer
+        optimizer used to train the model
+
+    fname: str
+        output file
+    """
+    torch.save(
+        {
+            "model": copy.deepcopy(model).to("cpu"),
+            "optimizer_state": optimizer.state_dict(),
+        },
+        fname,
+    )
+
+
+def dump_distribution(model, save_dir, epoch, n_particles, p0c, particles=False):
+    """
+    Writes a generative snapshot of the current beam of `model` to
+    `save_dir`/snapshot_{epoch}.pt, see `snapshots.save_snapshot`, and with
+    `particles` also `n_particles` materialized particles to dist_{epoch}.pt.
+    """
+    save_snapshot(
+        model.beam,
+        os.path.join(save_dir, f"snapshot_{epoch}.pt"),
+        epoch=epoch,
+        n_particles=n_particles,
+    )
+    if particles:
+        model_copy = copy.deepcopy(model).to("cpu")
+        model_copy.beam.n_active = None
+        model_copy.beam.set_base_beam(n_particles, p0c=torch.tensor(p0c))
+        torch.save(
+            model_copy.beam.forward().detach_clone(),
+            os.path.join(save_dir, f"dist_{epoch}.pt"),
+        )
+
+
+def load_checkpoint(warm_start):
+    """
+    Returns (model, optimizer_state) from a checkpoint written by
+    `save_checkpoint`, its loaded dict, or a bare model as returned by the
+    trainers (optimizer_state is None in that case).
+    """
+    if isinstance(warm_start, str):
+        warm_start = torch.load(warm_start, weights_only=False)
+
+    if isinstance(warm_start, dict):
+        return copy.deepcopy(warm_start["model"]), warm_start["optimizer_state"]
+
+    return copy.deepcopy(warm_start), None
+
 
 
 def train_1d_scan(
@@ -30,7 +110,8 @@ def train_1d_scan(
     save_as=None,
     lambda_=1e11,
     batch_size=10,
-    nn_transformer = NNTransform(2, 20, output_scale=1e-2)
+    nn_transformer = NNTransform(2, 20, output_scale=1e-2),
+    telemetry=None,
 ):
     """
     Trains beam model by scanning an arbitrary lattice.
@@ -46,6 +127,9 @@ def train_1d_scan(
     screen: ImageDiagnostic
         screen diagnostics
 
+    telemetry: TrainingTelemetry or None
+        step timing and loss logging. Default: print the loss every 100 epochs
+
     Returns
     -------
     predicted_beam: bmadx Beam
@@ -75,23 +159,30 @@ def train_1d_scan(
     model = PhaseSpaceReconstructionModel(lattice.copy(), screen, nn_beam)
 
     model = model.to(DEVICE)
+    telemetry = (telemetry or TrainingTelemetry()).attach(model)
 
     # train model
     optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
     loss_fn = MENTLoss(torch.tensor(lambda_))
 
     for i in range(n_epochs):
+        telemetry.start_epoch(i)
         for elem in train_dataloader:
             k, target_images = elem[0], elem[1]
+            telemetry.start_step()
             optimizer.zero_grad()
             output = model(k, scan_quad_id)
+            telemetry.mark("forward")
             loss = loss_fn(output, target_images)
+            telemetry.mark("loss")
             loss.backward()
+            telemetry.mark("backward")
             optimizer.step()
+            telemetry.end_step(len(k))
 
-        if i % 100 == 0:
-            print(i, loss)
+        telemetry.end_epoch(i, loss, optimizer)
 
+    telemetry.detach()
     model = model.to("cpu")
 
     predicted_beam = model.beam.forward().detach_clone()
@@ -115,6 +206,8 @@ def train_1d_scan_sext(
     batch_size=10,
     distribution_dump_frequency=500,
     distribution_dump_n_particles=100_000,
+    dump_particles=False,
+    telemetry=None,
 ):
     """
     Trains beam model by scanning an arbitrary lattice.
@@ -130,6 +223,13 @@ def train_1d_scan_sext(
     screen: ImageDiagnostic
         screen diagnostics
 
+    telemetry: TrainingTelemetry or None
+        step timing and loss logging. Default: print the loss every 100 epochs
+
+    dump_particles: bool
+        also write particle dumps next to the generative snapshots, see
+        `train_3d_scan`. Default: False
+
     Returns
     -------
     predicted_beam: bmadx Beam
@@ -160,35 +260,42 @@ def train_1d_scan_sext(
     model = SextPhaseSpaceReconstructionModel(lattice.copy(), screen, nn_beam)
 
     model = model.to(DEVICE)
+    telemetry = (telemetry or TrainingTelemetry()).attach(model)
 
     # train model
     optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
     loss_fn = MAELoss()
 
     for i in range(n_epochs + 1):
+        telemetry.start_epoch(i)
         for elem in train_dataloader:
             k, target_images = elem[0], elem[1]
+            telemetry.start_step()
             optimizer.zero_grad()
             output = model(k, scan_quad_id)
+            telemetry.mark("forward")
             loss = loss_fn(output, target_images)
+            telemetry.mark("loss")
             loss.backward()
+            telemetry.mark("backward")
             optimizer.step()
+            telemetry.end_step(len(k))
             
-        # dump current particle distribution to file
+        # snapshot of the current particle distribution
         if i % distribution_dump_frequency == 0:
             if save_dir is not None:
-                model_copy = copy.deepcopy(model).to("cpu")
-                model_copy.beam.set_base_beam(
-                    distribution_dump_n_particles, p0c=torch.tensor(p0c)
-                )
-                torch.save(
-                    model_copy.beam.forward().detach_clone(),
-                    os.path.join(save_dir, f"dist_{i}.pt"),
+                dump_distribution(
+                    model,
+                    save_dir,
+                    i,
+                    distribution_dump_n_particles,
+                    p0c,
+                    particles=dump_particles,
                 )
 
-        if i % 100 == 0:
-            print(i, loss)
+        telemetry.end_epoch(i, loss, optimizer)
 
+    telemetry.detach()
     model = model.to("cpu")
 
     predicted_beam = model.beam.forward().detach_clone()
@@ -209,6 +316,7 @@ def train_1d_scan_multi_gpu(
     save_as=None,
     lambda_=1e11,
     batch_size=10,
+    telemetry=None,
 ):
     """
     Trains beam model by scanning an arbitrary lattice.
@@ -224,6 +332,9 @@ def train_1d_scan_multi_gpu(
     screen: ImageDiagnostic
         screen diagnostics
 
+    telemetry: TrainingTelemetry or None
+        step timing and loss logging. Default: print the loss every 100 epochs
+
     Returns
     -------
     predicted_beam: bmadx Beam
@@ -255,6 +366,7 @@ def train_1d_scan_multi_gpu(
 
     model = torch.nn.DataParallel(model)
     model = model.to(DEVICE)
+    telemetry = (telemetry or TrainingTelemetry()).attach(model)
 
     # train model
     optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
@@ -262,17 +374,23 @@ def train_1d_scan_multi_gpu(
     loss_fn = loss_fn.to(DEVICE)
 
     for i in range(n_epochs):
+        telemetry.start_epoch(i)
         for elem in train_dataloader:
             k, target_images = elem[0], elem[1]
+            telemetry.start_step()
             optimizer.zero_grad()
             output = model(k, scan_quad_id)
+            telemetry.mark("forward")
             loss = loss_fn(output, target_images)
+            telemetry.mark("loss")
             loss.mean().backward()
+            telemetry.mark("backward")
             optimizer.step()
+            telemetry.end_step(len(k))
 
-        if i % 100 == 0:
-            print(i, loss)
+        telemetry.end_epoch(i, loss, optimizer)
 
+    telemetry.detach()
     model = model.module.to("cpu")
 
     predicted_beam = model.beam.forward().detach_clone()
@@ -297,8 +415,24 @@ def train_3d_scan(
     nn_transform=None,
     distribution_dump_frequency=1000,
     distribution_dump_n_particles=100_000,
+    dump_particles=False,
     use_decay=False,
     lr=0.01,
+    telemetry=None,
+    warm_start=None,
+    compile_step=False,
+    autocast_dtype=None,
+    normalization=None,
+    schedule=None,
+    prioritized_sampling=None,
+    guard=None,
+    method="adam",
+    warmup_epochs=100,
+    lbfgs_max_iter=20,
+    entropy_weight=0.0,
+    entropy_fn=None,
+    particle_adapter=None,
+    eval_loss=False,
 ):
     """
     Trains 6D phase space reconstruction model by using 3D scan data.
@@ -338,6 +472,94 @@ def train_3d_scan(
     batch_size: int
         batch size for the dataloader
 
+    telemetry: TrainingTelemetry or None
+        step timing and loss logging. Default: print the loss every 100 epochs
+
+    warm_start: model, checkpoint dict or str or None
+        previous result to continue from: the model returned by this
+        function, or a checkpoint (or its path) written by `save_checkpoint`,
+        which also restores the optimizer state. `nn_transform` is ignored.
+
+    compile_step: bool
+        compile the forward pass and loss with torch.compile (inductor,
+        static shapes), checked against eager mode on the first batch, see
+        `compilation.compile_training_step`. The no-grad full-batch
+        evaluations (`eval_loss`, the guard check of L-BFGS steps) use the
+        forward-only graphs of `compilation.compile_prediction`.
+        Default: False
+
+    autocast_dtype: torch.dtype or None
+        mixed precision mode, e.g. torch.bfloat16: the NN transform and the
+        screen kernel evaluation run under `torch.autocast` in this dtype,
+        tracking, histogram accumulation and the loss stay in float32. See
+        `precision.precision_drift` for the accuracy cost. Eager steps only,
+        ignored with `compile_step`. Default: None
+
+    normalization: PhaseSpaceNormalization or None
+        reconstruct in phase space coordinates whitened by a reference
+        covariance, e.g. `PhaseSpaceNormalization.from_twiss` of the design
+        optics. The default NN transform then has unit output scale.
+        Default: None
+
+    schedule: CoarseToFineSchedule or None
+        start with a subset of the particles, downsampled images and a wider
+        bandwidth, ramped to full fidelity over the first epochs. Default:
+        None
+
+    prioritized_sampling: bool, PrioritizedConfigSampler or None
+        draw batches in proportion to the running loss of each scan
+        configuration, with importance weights keeping the loss unbiased.
+        True uses a `PrioritizedConfigSampler` with default settings.
+        Default: None (uniform shuffling)
+
+    guard: DivergenceGuard or None
+        roll back to the last snapshot on non-finite losses or gradients
+        and loss spikes, see `guards.DivergenceGuard`. Default: None
+
+    method: 'adam', 'lbfgs' or 'hybrid'
+        optimizer. 'lbfgs' runs full-batch L-BFGS with strong Wolfe line
+        search on all scan configurations and the fixed base beam, one
+        `optimizer.step` of up to `lbfgs_max_iter` iterations per epoch.
+        'hybrid' runs Adam for `warmup_epochs` and L-BFGS afterwards.
+        Default: 'adam'
+
+    warmup_epochs: int
+        Adam epochs before switching to L-BFGS in 'hybrid' mode. Default: 100
+
+    lbfgs_max_iter: int
+        L-BFGS iterations per epoch. Default: 20
+
+    entropy_weight: float
+        weight of the maximum entropy term, the loss is the image loss minus
+        `entropy_weight` times the beam entropy. The entropy is exact for an
+        `nn_transform` with a density (`FlowTransform`) and the gaussian
+        entropy of the beam covariance otherwise. Eager steps only.
+        Default: 0
+
+    entropy_fn: callable or None
+        entropy estimate of the proposal beam used instead, e.g.
+        `functools.partial(modeling.calculate_knn_entropy, n_samples=1024)`.
+        Default: None
+
+    particle_adapter: ParticleCountAdapter or None
+        adapt the number of active particles, at most `n_particles`, to the
+        measurement noise during training, see `noise.ParticleCountAdapter`.
+        Default: None
+
+    dump_particles: bool
+        every `distribution_dump_frequency` epochs a generative snapshot of
+        the beam is written to `save_dir`, see `snapshots.SnapshotSeries`.
+        With `dump_particles` also `distribution_dump_n_particles`
+        particles, dist_{epoch}.pt. Default: False
+
+    eval_loss: bool
+        evaluate the full-batch loss of all scan configurations without
+        gradients at the end of every epoch and log it as `eval_loss` in the
+        telemetry epoch records, excluding its time. The epoch `loss` is the
+        last minibatch loss (Adam) or the loss before the step (L-BFGS), so
+        use `eval_loss` to compare methods, see
+        `telemetry.time_to_loss(..., key="eval_loss")`. Default: False
+
     Returns
     -------
     predicted_beam: bmadx Beam
@@ -345,6 +567,18 @@ def train_3d_scan(
 
     """
 
+    if method not in ("adam", "lbfgs", "hybrid"):
+        raise ValueError(f"unknown method '{method}'")
+    lbfgs_start = {"adam": n_epochs + 1, "lbfgs": 0, "hybrid": warmup_epochs}[method]
+    if schedule is not None and schedule.full_fidelity_epoch > lbfgs_start:
+        raise ValueError("L-BFGS needs full fidelity, finish the schedule first")
+    if compile_step and entropy_weight:
+        raise ValueError("the entropy term is not supported with compile_step")
+    if schedule is not None and particle_adapter is not None:
+        raise ValueError("use either a schedule or a particle_adapter")
+    if schedule is not None and eval_loss:
+        raise ValueError("eval_loss needs full fidelity, not supported with a schedule")
+
     # Device selection:
     DEVICE = torch.device(device)
     print(f"Using device: {DEVICE}")
@@ -356,65 +590,548 @@ def train_3d_scan(
     train_dataloader = DataLoader(
         train_dset_device, batch_size=batch_size, shuffle=True
     )
+    sampler = None
+    if isinstance(prioritized_sampling, PrioritizedConfigSampler):
+        sampler = prioritized_sampling
+    elif prioritized_sampling:
+        sampler = PrioritizedConfigSampler(len(params), batch_size)
 
     # create phase space reconstruction model
-    nn_transformer = nn_transform or NNTransform(2, 20, output_scale=1e-3)
-    nn_beam = InitialBeam(
-        nn_transformer,
-        torch.distributions.MultivariateNormal(torch.zeros(6), torch.eye(6)),
-        n_particles,
-        p0c=torch.tensor(p0c),
-    )
-    model = PhaseSpaceReconstructionModel3D(lattice.copy(), screen, nn_beam)
+    optimizer_state = None
+    if warm_start is not None:
+        model, optimizer_state = load_checkpoint(warm_start)
+        model.base_lattice = lattice.copy()
+        model.diagnostic = screen
+        if len(model.beam.base_beam.data) != n_particles:
+            model.beam.set_base_beam(n_particles, p0c=torch.tensor(p0c))
+    else:
+        output_scale = 1e-3 if normalization is None else 1.0
+        nn_transformer = nn_transform or NNTransform(
+            2, 20, output_scale=output_scale
+        )
+        nn_beam = InitialBeam(
+            nn_transformer,
+            torch.distributions.MultivariateNormal(torch.zeros(6), torch.eye(6)),
+            n_particles,
+            normalization=normalization,
+            p0c=torch.tensor(p0c),
+        )
+        model = PhaseSpaceReconstructionModel3D(lattice.copy(), screen, nn_beam)
+
+    if entropy_fn is not None:
+        model.entropy_fn = entropy_fn
 
     model = model.to(DEVICE)
+    telemetry = (telemetry or TrainingTelemetry()).attach(
+        model, hooks=not compile_step
+    )
 
     # train model
     optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    # the checkpoint of an L-BFGS run holds no Adam state
+    if optimizer_state is not None and all(
+        "exp_avg" in state for state in optimizer_state["state"].values()
+    ):
+        optimizer.load_state_dict(optimizer_state)
+        for group in optimizer.param_groups:
+            group["lr"] = lr
 
     if use_decay:
         gamma = 0.999  # final learning rate will be gamma * lr
         scheduler = ExponentialLR(optimizer, gamma)
-    loss_fn = MAELoss()
+    loss_fn = MAELoss(reduction="none")
+
+    if guard is not None:
+        guard.snapshot(model, optimizer, 0)
+
+    if compile_step:
+        params_0, images_0 = next(iter(train_dataloader))[:2]
+        compiled_loss = compile_training_step(
+            model, loss_fn, params_0, ids, images_0
+        )
+        if eval_loss or (guard is not None and lbfgs_start <= n_epochs):
+            compiled_model = compile_prediction(model, params, ids)
+
+    def full_batch_loss():
+        if compile_step and torch.is_grad_enabled():
+            return compiled_loss(params, ids, imgs).mean()
+        if compile_step:
+            return loss_fn(compiled_model(params, ids), imgs).mean()
+        with torch.autocast(
+            DEVICE.type,
+            dtype=autocast_dtype,
+            enabled=autocast_dtype is not None,
+        ):
+            output = model(params, ids)
+        loss = loss_fn(output, imgs).mean()
+        if entropy_weight:
+            loss = loss - entropy_weight * output[1]
+        return loss
+
+    lbfgs_bad_gradients = False
+    # loss of the last step that passed the guard, rejected losses are not
+    # logged
+    accepted_loss = None
+
+    def lbfgs_closure():
+        nonlocal lbfgs_bad_gradients
+        optimizer.zero_grad()
+        loss = full_batch_loss()
+        loss.backward()
+        if guard is not None and not guard.check_gradients(model):
+            lbfgs_bad_gradients = True
+        return loss
 
     for i in range(n_epochs + 1):
-        for elem in train_dataloader:
+        telemetry.start_epoch(i)
+        if i == lbfgs_start:
+            optimizer = torch.optim.LBFGS(
+                model.parameters(),
+                lr=1.0,
+                max_iter=lbfgs_max_iter,
+                line_search_fn="strong_wolfe",
+            )
+            if guard is not None:
+                guard.snapshot(model, optimizer, i)
+
+        if particle_adapter is not None:
+            # L-BFGS needs the fixed full base beam
+            model.beam.n_active = (
+                particle_adapter.n_particles(i, model, params, ids)
+                if i < lbfgs_start
+                else None
+            )
+        if schedule is not None:
+            model.beam.n_active = schedule.n_particles(i, n_particles)
+            downsample = schedule.downsample_factor(i)
+            if model.diagnostic is not schedule.screen(i, screen):
+                model.diagnostic = schedule.screen(i, screen).to(DEVICE)
+                telemetry.attach(model, hooks=not compile_step)
+
+        if i >= lbfgs_start:
+            # full batch, every evaluation of the closure sees all configurations
+            batches = []
+            telemetry.start_step()
+            loss = optimizer.step(lbfgs_closure)
+            telemetry.end_step(len(params))
+            if guard is None:
+                accepted_loss = loss.detach()
+            else:
+                # step returns the loss before the step, check the new parameters
+                if guard.check_parameters(model):
+                    with torch.no_grad():
+                        loss = full_batch_loss()
+                if (
+                    lbfgs_bad_gradients
+                    or not guard.check_parameters(model)
+                    or not guard.check_loss(loss)
+                ):
+                    guard.rollback(model, optimizer, i, telemetry)
+                else:
+                    accepted_loss = loss.detach()
+                lbfgs_bad_gradients = False
+        elif sampler is None:
+            batches = train_dataloader
+        else:
+            batches = ((params[idx], imgs[idx], idx) for idx in sampler)
+
+        for elem in batches:
             params_i, target_images = elem[0], elem[1]
+            if schedule is not None:
+                target_images = downsample_images(target_images, downsample)
+            telemetry.start_step()
             optimizer.zero_grad()
-            output = model(params_i, ids)
-            loss = loss_fn(output, target_images)
+            if compile_step:
+                config_loss = compiled_loss(params_i, ids, target_images)
+                telemetry.mark("forward")
+            else:
+                with torch.autocast(
+                    DEVICE.type,
+                    dtype=autocast_dtype,
+                    enabled=autocast_dtype is not None,
+                ):
+                    output = model(params_i, ids)
+                telemetry.mark("forward")
+                config_loss = loss_fn(output, target_images)
+
+            if sampler is None:
+                loss = config_loss.mean()
+            else:
+                loss = (sampler.weights(elem[2]) * config_loss).mean()
+            if entropy_weight:
+                loss = loss - entropy_weight * output[1]
+            telemetry.mark("loss")
+            if guard is not None and not guard.check_loss(loss):
+                guard.rollback(model, optimizer, i, telemetry)
+                continue
+
             loss.backward()
+            telemetry.mark("backward")
+            if guard is not None and not guard.check_gradients(model):
+                guard.rollback(model, optimizer, i, telemetry)
+                continue
+            # only steps that pass the guard update the priorities
+            if sampler is not None:
+                sampler.update(elem[2], config_loss)
             optimizer.step()
-
-        if i % 100 == 0:
-            print(i, loss)
-
-        # dump current particle distribution to file
+            accepted_loss = loss.detach()
+            telemetry.end_step(len(params_i))
+
+        if eval_loss:
+            start = time.perf_counter()
+            with torch.no_grad():
+                full_loss = full_batch_loss()
+            telemetry.end_epoch(
+                i, accepted_loss, optimizer, full_loss, time.perf_counter() - start
+            )
+        else:
+            telemetry.end_epoch(i, accepted_loss, optimizer)
+        if guard is not None:
+            guard.end_epoch(model, optimizer, i)
+
+        # snapshot of the current particle distribution
         if i % distribution_dump_frequency == 0:
             if save_dir is not None:
-                model_copy = copy.deepcopy(model).to("cpu")
-                model_copy.beam.set_base_beam(
-                    distribution_dump_n_particles, p0c=torch.tensor(p0c)
-                )
-                torch.save(
-                    model_copy.beam.forward().detach_clone(),
-                    os.path.join(save_dir, f"dist_{i}.pt"),
+                dump_distribution(
+                    model,
+                    save_dir,
+                    i,
+                    distribution_dump_n_particles,
+                    p0c,
+                    particles=dump_particles,
                 )
-        if use_decay:
+        if use_decay and i < lbfgs_start:
             scheduler.step()
             if i % 100 == 0:
                 print(scheduler.get_last_lr())
 
+    telemetry.detach()
+    if schedule is not None or particle_adapter is not None:
+        model.beam.n_active = None
+        model.diagnostic = screen
     model = model.to("cpu")
 
     predicted_beam = model.beam.forward().detach_clone()
 
     if save_dir is not None:
         torch.save(predicted_beam, "3d_scan_result.pt")
+        save_checkpoint(model, optimizer, os.path.join(save_dir, "checkpoint.pt"))
 
     return predicted_beam, copy.deepcopy(model)
 
 
+def fine_tune_3d_scan(
+    warm_start,
+    train_dset,
+    lattice,
+    p0c,
+    screen,
+    ids,
+    new_dset=None,
+    n_epochs=200,
+    lr=1e-3,
+    **kwargs,
+):
+    """
+    Re-reconstructs a slowly drifting beam by fine-tuning a previous result
+    on a new scan, or on the previous scan with newly appended scan points,
+    with a short schedule.
+
+    Parameters
+    ----------
+    warm_start: model, checkpoint dict or str
+        previous result, see `train_3d_scan`
+
+    train_dset: ImageDataset3D
+        new scan, or the scan the previous result was trained on
+
+    new_dset: ImageDataset3D or None
+        scan points appended to `train_dset`
+
+    n_epochs: int
+        number of fine-tuning epochs. Default: 200
+
+    lr: float
+        fine-tuning learning rate. Default: 1e-3
+
+    kwargs:
+        passed to `train_3d_scan`
+
+    Returns
+    -------
+    predicted_beam, model: see `train_3d_scan`
+    """
+    if new_dset is not None:
+        train_dset = ImageDataset3D(
+            torch.cat((train_dset.params, new_dset.params)),
+            torch.cat((train_dset.images, new_dset.images)),
+        )
+
+    return train_3d_scan(
+        train_dset,
+        lattice,
+        p0c,
+        screen,
+        ids,
+        n_epochs=n_epochs,
+        lr=lr,
+        warm_start=warm_start,
+        **kwargs,
+    )
+
+
+def train_conditional_3d_scan(
+    train_dsets,
+    settings,
+    lattice,
+    p0c,
+    screen,
+    ids,
+    n_epochs=100,
+    device="cpu",
+    n_particles=10_000,
+    save_dir=None,
+    batch_size=10,
+    nn_transform=None,
+    use_decay=False,
+    lr=0.01,
+    telemetry=None,
+    warm_start=None,
+):
+    """
+    Trains one beam model conditioned on machine settings jointly on 3D
+    scans taken at several settings. A reconstruction at a new setting is
+    then a forward pass, `model.beam(new_settings)`, or a short fine-tune
+    with `warm_start` on a scan at that setting.
+
+    Parameters
+    ----------
+    train_dsets: list of ImageDataset3D
+        one scan per machine setting
+
+    settings: Tensor
+        machine settings of the scans, shape [n_scans, n_settings]
+
+    lattice: bmadx TorchLattice
+        6D diagnostics lattice with quadrupole, TDC and dipole
+
+    p0c: float
+        beam momentum
+
+    screen: ImageDiagnostic
+        screen diagnostics
+
+    ids: list of ints
+        Indices of the elements to be scanned: [quad_id, tdc_id, dipole_id]
+
+    n_epochs: int
+        number of epochs, each visits all scans in random order
+
+    nn_transform: ConditionalNNTransform or None
+        beam transformation. Default: 2 hidden layers of width 50
+
+    warm_start: model, checkpoint dict or str or None
+        previous result to continue from, see `train_3d_scan`. The settings
+        normalization of the previous model is kept.
+
+    See `train_3d_scan` for the other parameters.
+
+    Returns
+    -------
+    predicted_beams: list of bmadx Beams
+        reconstructed beam at each training setting
+
+    model: ConditionalPhaseSpaceReconstructionModel3D
+        trained model
+    """
+
+    # Device selection:
+    DEVICE = torch.device(device)
+    print(f"Using device: {DEVICE}")
+
+    settings = settings.to(DEVICE)
+    train_dataloaders = [
+        DataLoader(
+            ImageDataset3D(dset.params.to(DEVICE), dset.images.to(DEVICE)),
+            batch_size=batch_size,
+            shuffle=True,
+        )
+        for dset in train_dsets
+    ]
+
+    # create phase space reconstruction model
+    optimizer_state = None
+    if warm_start is not None:
+        model, optimizer_state = load_checkpoint(warm_start)
+        model.base_lattice = lattice.copy()
+        model.diagnostic = screen
+        if len(model.beam.base_beam.data) != n_particles:
+            model.beam.set_base_beam(n_particles, p0c=torch.tensor(p0c))
+    else:
+        nn_transformer = nn_transform or ConditionalNNTransform(
+            2, 50, settings.shape[-1], output_scale=1e-3
+        )
+        nn_transformer.set_settings_normalization(settings.cpu())
+        nn_beam = InitialBeam(
+            nn_transformer,
+            torch.distributions.MultivariateNormal(torch.zeros(6), torch.eye(6)),
+            n_particles,
+            p0c=torch.tensor(p0c),
+        )
+        model = ConditionalPhaseSpaceReconstructionModel3D(
+            lattice.copy(), screen, nn_beam
+        )
+
+    model = model.to(DEVICE)
+    telemetry = (telemetry or TrainingTelemetry()).attach(model)
+
+    # train model
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    if optimizer_state is not None:
+        optimizer.load_state_dict(optimizer_state)
+        for group in optimizer.param_groups:
+            group["lr"] = lr
+
+    if use_decay:
+        gamma = 0.999  # final learning rate will be gamma * lr
+        scheduler = ExponentialLR(optimizer, gamma)
+    loss_fn = MAELoss()
+
+    for i in range(n_epochs + 1):
+        telemetry.start_epoch(i)
+        for j in torch.randperm(len(train_dataloaders)).tolist():
+            for elem in train_dataloaders[j]:
+                params_i, target_images = elem[0], elem[1]
+                telemetry.start_step()
+                optimizer.zero_grad()
+                output = model(params_i, ids, settings[j])
+                telemetry.mark("forward")
+                loss = loss_fn(output, target_images)
+                telemetry.mark("loss")
+                loss.backward()
+                telemetry.mark("backward")
+                optimizer.step()
+                telemetry.end_step(len(params_i))
+
+        telemetry.end_epoch(i, loss, optimizer)
+        if use_decay:
+            scheduler.step()
+
+    telemetry.detach()
+    model = model.to("cpu")
+
+    predicted_beams = [
+        model.beam(setting).detach_clone() for setting in settings.cpu()
+    ]
+
+    if save_dir is not None:
+        save_checkpoint(model, optimizer, os.path.join(save_dir, "checkpoint.pt"))
+
+    return predicted_beams, copy.deepcopy(model)
+
+
+def train_gaussian_mixture(
+    train_dset,
+    lattice,
+    p0c,
+    screen,
+    ids,
+    n_components=4,
+    n_epochs=1000,
+    n_particles=100_000,
+    lr=0.01,
+    reference=None,
+    device="cpu",
+    telemetry=None,
+):
+    """
+    Fits a `GaussianMixtureBeam` to 3D scan data with analytically rendered
+    images, full batch over all scan configurations. The transfer maps of
+    the scan are computed once, no particles are tracked.
+
+    Parameters
+    ----------
+    train_dset: ImageDataset3D
+        training data
+
+    lattice: bmadx TorchLattice
+        6D diagnostics lattice with quadrupole, TDC and dipole
+
+    p0c: float
+        beam momentum
+
+    screen: ImageDiagnostic
+        screen diagnostics
+
+    ids: list of ints
+        Indices of the elements to be scanned: [quad_id, tdc_id, dipole_id]
+
+    n_components: int
+        number of mixture components. Default: 4
+
+    n_epochs: int
+        number of optimizer steps. Default: 1000
+
+    n_particles: int
+        number of particles of the returned beam
+
+    reference: (mean, cov) or None
+        reference moments of the mixture. Default: `fit_gaussian_moments`
+        of the scan
+
+    device: 'cpu' or 'cuda:0'
+        device to fit the mixture on
+
+    telemetry: TrainingTelemetry or None
+        step timing and loss logging. Default: print the loss every 100 epochs
+
+    Returns
+    -------
+    predicted_beam: bmadx Beam
+        beam sampled from the fitted mixture
+
+    mixture: GaussianMixtureBeam
+        fitted mixture
+    """
+    # Device selection:
+    DEVICE = torch.device(device)
+    print(f"Using device: {DEVICE}")
+
+    mean, cov = reference or fit_gaussian_moments(
+        train_dset, lattice, screen, ids, p0c
+    )
+    mixture = GaussianMixtureBeam(n_components, mean, cov, p0c).to(DEVICE)
+    R, offset = transfer_matrices(lattice, train_dset.params, ids, p0c)
+    R, offset = R.to(DEVICE), offset.to(DEVICE)
+    imgs = train_dset.images.to(DEVICE)
+    screen = copy.deepcopy(screen).to(DEVICE)
+    telemetry = (telemetry or TrainingTelemetry()).attach(mixture)
+
+    optimizer = torch.optim.Adam(mixture.parameters(), lr=lr)
+    loss_fn = MAELoss()
+
+    for i in range(n_epochs + 1):
+        telemetry.start_epoch(i)
+        telemetry.start_step()
+        optimizer.zero_grad()
+        images = mixture.images(R, offset, screen)
+        telemetry.mark("forward")
+        loss = loss_fn((images,), imgs)
+        telemetry.mark("loss")
+        loss.backward()
+        telemetry.mark("backward")
+        optimizer.step()
+        telemetry.end_step(len(imgs))
+        telemetry.end_epoch(i, loss, optimizer)
+
+    telemetry.detach()
+    mixture = mixture.to("cpu")
+    with torch.no_grad():
+        predicted_beam = mixture(n_particles)
+
+    return predicted_beam, mixture
+
+
 def train_3d_scan_parallel_gpus(
     train_dset,
     lattice,
@@ -427,6 +1144,7 @@ def train_3d_scan_parallel_gpus(
     save_as=None,
     lambda_=1e11,
     batch_size=10,
+    telemetry=None,
 ):
     """
     Trains beam model by scanning an arbitrary lattice.
@@ -444,6 +1162,9 @@ def train_3d_scan_parallel_gpus(
     screen: ImageDiagnostic
         screen diagnostics
 
+    telemetry: TrainingTelemetry or None
+        step timing and loss logging. Default: print the loss every 100 epochs
+
     Returns
     -------
     predicted_beam: bmadx Beam
@@ -476,6 +1197,7 @@ def train_3d_scan_parallel_gpus(
 
     model = torch.nn.DataParallel(model)
     model = model.to(DEVICE)
+    telemetry = (telemetry or TrainingTelemetry()).attach(model)
 
     # train model
     optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
@@ -484,17 +1206,23 @@ def train_3d_scan_parallel_gpus(
     loss_fn = loss_fn.to(DEVICE)
 
     for i in range(n_epochs):
+        telemetry.start_epoch(i)
         for elem in train_dataloader:
             params_i, target_images = elem[0], elem[1]
+            telemetry.start_step()
             optimizer.zero_grad()
             output = model(params_i, ids)
+            telemetry.mark("forward")
             loss = loss_fn(output, target_images)
+            telemetry.mark("loss")
             loss.mean().backward()
+            telemetry.mark("backward")
             optimizer.step()
+            telemetry.end_step(len(params_i))
 
-        if i % 100 == 0:
-            print(i, loss)
+        telemetry.end_epoch(i, loss, optimizer)
 
+    telemetry.detach()
     model = model.module.to("cpu")
 
     predicted_beam = model.beam.forward().detach_clone()
@@ -524,7 +1252,12 @@ def train_3d_scan_2screens(
     nn_transform=None,
     distribution_dump_frequency=1000,
     distribution_dump_n_particles=100_000,
-    use_decay=False
+    dump_particles=False,
+    use_decay=False,
+    telemetry=None,
+    warm_start=None,
+    guard=None,
+    shot_jitter=False,
 ):
     """
     Trains 6D phase space reconstruction model by using 3D scan data.
@@ -567,6 +1300,18 @@ def train_3d_scan_2screens(
         image divergence parameter for the loss function
     batch_size: int
         batch size for the dataloader
+    telemetry: TrainingTelemetry or None
+        step timing and loss logging. Default: print the loss every 100 epochs
+    warm_start: model, checkpoint dict or str or None
+        previous result to continue from, see `train_3d_scan`
+    guard: DivergenceGuard or None
+        roll back to the last snapshot on divergence, see `train_3d_scan`
+    shot_jitter: bool
+        fit a learnable screen shift for every shot, see
+        `modeling.ShotJitter`. Default: False
+    dump_particles: bool
+        also write particle dumps next to the generative snapshots, see
+        `train_3d_scan`. Default: False
 
     Returns
     -------
@@ -582,66 +1327,106 @@ def train_3d_scan_2screens(
     imgs = train_dset.images.to(DEVICE)
     n_imgs_per_param = imgs.shape[-3]
 
-    train_dset_device = ImageDataset3D(params, imgs)
+    # configuration indices select the shot offsets of a batch
+    train_dset_device = TensorDataset(params, imgs, torch.arange(len(params)))
     train_dataloader = DataLoader(
         train_dset_device, batch_size=batch_size, shuffle=True
     )
 
     # create phase space reconstruction model
-    nn_transformer = nn_transform or NNTransform(2, 20, output_scale=1e-2)
-    nn_beam = InitialBeam(
-        nn_transformer,
-        torch.distributions.MultivariateNormal(torch.zeros(6), torch.eye(6)),
-        n_particles,
-        p0c=torch.tensor(p0c),
-    )
-    model = PhaseSpaceReconstructionModel3D_2screens(
-        lattice0.copy(), lattice1.copy(), screen0, screen1, nn_beam
-    )
+    optimizer_state = None
+    if warm_start is not None:
+        model, optimizer_state = load_checkpoint(warm_start)
+        model.lattice0 = lattice0.copy()
+        model.lattice1 = lattice1.copy()
+        model.diagnostic0 = screen0
+        model.diagnostic1 = screen1
+        if len(model.beam.base_beam.data) != n_particles:
+            model.beam.set_base_beam(n_particles, p0c=torch.tensor(p0c))
+    else:
+        nn_transformer = nn_transform or NNTransform(2, 20, output_scale=1e-2)
+        nn_beam = InitialBeam(
+            nn_transformer,
+            torch.distributions.MultivariateNormal(torch.zeros(6), torch.eye(6)),
+            n_particles,
+            p0c=torch.tensor(p0c),
+        )
+        model = PhaseSpaceReconstructionModel3D_2screens(
+            lattice0.copy(), lattice1.copy(), screen0, screen1, nn_beam
+        )
+    if shot_jitter and getattr(model, "jitter", None) is None:
+        model.jitter = ShotJitter(imgs.shape[:-3], n_imgs_per_param)
 
     model = model.to(DEVICE)
+    telemetry = (telemetry or TrainingTelemetry()).attach(model)
 
     # train model
     optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
+    # the checkpoint of a run without shot jitter has fewer parameters
+    if optimizer_state is not None and len(
+        optimizer_state["param_groups"][0]["params"]
+    ) == len(optimizer.param_groups[0]["params"]):
+        optimizer.load_state_dict(optimizer_state)
     
     if use_decay:
         gamma = 0.999  # final learning rate will be gamma * lr
         scheduler = ExponentialLR(optimizer, gamma)
     loss_fn = MAELoss()
 
+    if guard is not None:
+        guard.snapshot(model, optimizer, 0)
+
+    # loss of the last step that passed the guard, see `train_3d_scan`
+    accepted_loss = None
     for i in range(n_epochs + 1):
+        telemetry.start_epoch(i)
         for elem in train_dataloader:
             params_i, target_images = elem[0], elem[1]
+            telemetry.start_step()
             optimizer.zero_grad()
-            output = model(params_i, n_imgs_per_param, ids)
+            output = model(params_i, n_imgs_per_param, ids, elem[2])
+            telemetry.mark("forward")
             loss = loss_fn(output, target_images)
+            telemetry.mark("loss")
+            if guard is not None and not guard.check_loss(loss):
+                guard.rollback(model, optimizer, i, telemetry)
+                continue
             loss.backward()
+            telemetry.mark("backward")
+            if guard is not None and not guard.check_gradients(model):
+                guard.rollback(model, optimizer, i, telemetry)
+                continue
             optimizer.step()
+            accepted_loss = loss.detach()
+            telemetry.end_step(len(params_i))
 
-        if i % 100 == 0:
-            print(i, loss)
+        telemetry.end_epoch(i, accepted_loss, optimizer)
+        if guard is not None:
+            guard.end_epoch(model, optimizer, i)
 
-        # dump current particle distribution to file
+        # snapshot of the current particle distribution
         if i % distribution_dump_frequency == 0:
             if save_dir is not None:
-                model_copy = copy.deepcopy(model).to("cpu")
-                model_copy.beam.set_base_beam(
-                    distribution_dump_n_particles, p0c=torch.tensor(p0c)
-                )
-                torch.save(
-                    model_copy.beam.forward().detach_clone(),
-                    os.path.join(save_dir, f"dist_{i}.pt"),
+                dump_distribution(
+                    model,
+                    save_dir,
+                    i,
+                    distribution_dump_n_particles,
+                    p0c,
+                    particles=dump_particles,
                 )
         if use_decay:
             scheduler.step()
             if i % 100 == 0:
                 print(scheduler.get_last_lr())
 
+    telemetry.detach()
     model = model.to("cpu")
 
     predicted_beam = model.beam.forward().detach_clone()
 
     if save_dir is not None:
         torch.save(predicted_beam, "3d_scan_result.pt")
+        save_checkpoint(model, optimizer, os.path.join(save_dir, "checkpoint.pt"))
 
     return predicted_beam, copy.deepcopy(model)
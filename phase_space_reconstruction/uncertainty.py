@@ -0,0 +1,151 @@
+import torch
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
+
+from phase_space_reconstruction.losses import MAELoss, normalize_images
+from phase_space_reconstruction.modeling import calculate_covariance
+
+
+class LastLayerLaplace:
+    def __init__(self, model, prior_precision=None, noise=None):
+        """
+        Laplace approximation of the posterior of the output layer weights
+        of the `NNTransform` of a trained `PhaseSpaceReconstructionModel3D`,
+        an uncertainty estimate from a single reconstruction instead of an
+        ensemble of them.
+
+        The image loss is read as the negative log-likelihood of Laplace
+        distributed pixel residuals with scale `noise`. The posterior
+        precision is its Fisher information J^T J / noise^2, with J the
+        Jacobian of the normalized images, plus an isotropic
+        `prior_precision`. The Fisher information is computed exactly, one
+        column per output layer weight, from a Jacobian-vector product of
+        the tracked images and its backward pass. Weight samples give beams
+        with the same base particles, see `sample_particles` and
+        `covariance_stats`.
+
+        Parameters
+        ----------
+        model: PhaseSpaceReconstructionModel3D
+            trained model with an `NNTransform` or `ConditionalNNTransform`
+
+        prior_precision: float or None
+            precision of the gaussian weight prior. Default: maximizes the
+            evidence, by the fixed point iteration
+            prior_precision = n_effective / |weights|^2
+
+        noise: float or None
+            pixel noise of the normalized images, see
+            `noise.measurement_noise`. Default: the final image loss
+        """
+        self.model = model
+        self.prior_precision = prior_precision
+        self.noise = noise
+
+        stack = getattr(model.beam.transformer, "stack", None)
+        if stack is None or not isinstance(stack[-1], torch.nn.Linear):
+            raise ValueError("the beam transformer has no linear output layer")
+        self.layer = stack[-1]
+
+        self.mean = None
+        self.precision_tril = None
+
+    def fit(self, dset, ids):
+        """
+        Curvature pass over the scan `dset` (ImageDataset3D) at the trained
+        weights. Returns self.
+        """
+        weights = list(self.layer.parameters())
+        self.mean = parameters_to_vector(weights).detach().clone()
+
+        output = self.model(dset.params, ids)
+        noise = self.noise or MAELoss()(output, dset.images).item()
+        images = normalize_images(output[0])
+
+        # J v by the double backward trick: J^T u is linear in u, its
+        # derivative w.r.t. u in the direction v is J v
+        u = torch.zeros_like(images, requires_grad=True)
+        vjp = torch.autograd.grad(images, weights, u, create_graph=True)
+
+        # column k of J^T J is J^T J e_k
+        sizes = [weight.numel() for weight in weights]
+        columns = []
+        for basis in torch.eye(len(self.mean)).to(self.mean):
+            tangents = [
+                tangent.view_as(weight)
+                for tangent, weight in zip(basis.split(sizes), weights)
+            ]
+            jvp = torch.autograd.grad(vjp, u, tangents, retain_graph=True)[0]
+            column = torch.autograd.grad(images, weights, jvp, retain_graph=True)
+            columns.append(parameters_to_vector(column))
+
+        # double precision, the curvature spans many orders of magnitude
+        fisher = torch.stack(columns).double() / noise**2
+        fisher = (fisher + fisher.T) / 2
+        prior_precision = self.prior_precision
+        if prior_precision is None:
+            eigenvalues = torch.linalg.eigvalsh(fisher).clamp(min=0)
+            norm = self.mean.double().pow(2).sum()
+            prior_precision = 1.0
+            for _ in range(100):
+                n_effective = (eigenvalues / (eigenvalues + prior_precision)).sum()
+                prior_precision = (n_effective / norm).item()
+        self.fitted_prior_precision = prior_precision
+
+        precision = fisher + prior_precision * torch.eye(len(self.mean)).double()
+        self.precision_tril = torch.linalg.cholesky(precision)
+        return self
+
+    def _sample_weights(self):
+        # x = mean + L^-T z has covariance (L L^T)^-1
+        z = torch.randn(len(self.mean), 1).double()
+        perturbation = torch.linalg.solve_triangular(
+            self.precision_tril.T, z, upper=True
+        )
+        return self.mean + perturbation.squeeze(-1).to(self.mean)
+
+    def sample_beams(self, n_samples, n_particles=None):
+        """
+        Beams of `n_samples` posterior weight samples, with `n_particles`
+        base particles. Default: the base beam of the model.
+        """
+        if self.precision_tril is None:
+            raise RuntimeError("call fit first")
+
+        beam = self.model.beam
+        base_beam = beam.base_beam
+        if n_particles is not None:
+            beam.set_base_beam(
+                n_particles, p0c=base_beam.p0c, s=base_beam.s, mc2=base_beam.mc2
+            )
+            beam.base_beam = beam.base_beam.to(base_beam.data.device)
+
+        beams = []
+        try:
+            with torch.no_grad():
+                for _ in range(n_samples):
+                    weights = self._sample_weights()
+                    vector_to_parameters(weights, self.layer.parameters())
+                    beams.append(beam().detach_clone())
+        finally:
+            vector_to_parameters(self.mean, self.layer.parameters())
+            beam.base_beam = base_beam
+
+        return beams
+
+    def sample_particles(self, n_samples, n_particles=None):
+        """
+        Particle coordinates of `n_samples` posterior beams as a numpy
+        array [n_samples, 6, n_particles], the layout of the ensemble
+        particles in `examples/synthetic_6d/stats.get_all_covs`.
+        """
+        beams = self.sample_beams(n_samples, n_particles)
+        return torch.stack([beam.data.T for beam in beams]).numpy()
+
+    def covariance_stats(self, n_samples, n_particles=None):
+        """
+        Beam covariances of `n_samples` posterior samples, their mean and
+        standard deviation, like `stats.get_all_covs`.
+        """
+        beams = self.sample_beams(n_samples, n_particles)
+        all_cov = torch.stack([calculate_covariance(beam) for beam in beams])
+        return all_cov, all_cov.mean(dim=0), all_cov.std(dim=0)